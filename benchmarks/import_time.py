@@ -0,0 +1,65 @@
+"""
+Checks how long the client modules take to import in a fresh interpreter,
+and that they don't pull in dependencies only some commands need.
+
+    python benchmarks/import_time.py --budget-ms 300
+
+Prints one JSON object per module and exits non-zero if any module is over
+budget or imported one of its deferred dependencies.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.abspath(os.path.dirname(__file__) + '/../')
+
+# module -> dependencies it must only import when they're actually used
+MODULES = {
+    'simplecoin_rpc_client.sc_rpc': ['tabulate', 'yaml', 'argparse', 'requests', 'urllib3'],
+    'simplecoin_rpc_client.manage': ['tabulate', 'requests', 'sqlalchemy'],
+}
+
+PROBE = """
+import json, sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print(json.dumps({{'ms': elapsed * 1000,
+                   'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def probe(module, deferred):
+    out = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(module=module, deferred=deferred)],
+        cwd=ROOT)
+    return json.loads(out.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='import time check')
+    parser.add_argument('--budget-ms', type=float, default=300)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    ok = True
+    for module, deferred in sorted(MODULES.items()):
+        runs = [probe(module, deferred) for _ in xrange(args.repeat)]
+        best = min(run['ms'] for run in runs)
+        loaded = runs[0]['loaded']
+        passed = best <= args.budget_ms and not loaded
+        ok = ok and passed
+        print(json.dumps({'module': module,
+                          'best_ms': round(best, 1),
+                          'budget_ms': args.budget_ms,
+                          'eagerly_imported': loaded,
+                          'ok': passed}, sort_keys=True))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
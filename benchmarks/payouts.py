@@ -0,0 +1,405 @@
+"""
+Drives the full payout cycle (pull_payouts, send_payout, associate_all and
+confirm_trans) against local stand-ins for the SimpleCoin RPC server and the
+coinserver, at a configurable number of payouts and currencies.
+
+    python benchmarks/payouts.py --payouts 1000 100000 1000000 --currencies 1 10 50
+
+Payouts are split evenly between the currencies, each of which gets its own
+sqlite database in a temporary directory. Every (payouts, currencies) scale
+runs in a fresh child process so that its peak RSS is its own. Prints one
+JSON object per scale with per phase wall time, throughput and per currency
+latency percentiles, client side request latency percentiles per SC endpoint
+and coinserver method, and peak RSS.
+
+Extra sc_rpc_client settings can be given with --set, eg.
+--set pull_page_size=10000 --set rpc_compress=True
+"""
+import argparse
+import BaseHTTPServer
+import SocketServer
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urlparse
+import yaml
+
+from decimal import Decimal
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from itsdangerous import TimedSerializer, URLSafeTimedSerializer
+from cryptokit.rpc_wrapper import CoinRPC
+from simplecoin_rpc_client.sc_rpc import SCRPCClient
+
+
+SECRET = 'benchmark'
+ADDRESS_VERSION = 111
+B58_CHARS = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def b58check(version, payload):
+    """ Base58Check encodes payload, so addresses pass the client's version
+    check """
+    data = chr(version) + payload
+    data += hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+    num = int(data.encode('hex'), 16)
+    out = ''
+    while num:
+        num, rem = divmod(num, 58)
+        out = B58_CHARS[rem] + out
+    pad = len(data) - len(data.lstrip('\0'))
+    return '1' * pad + out
+
+
+def make_payouts(currency, count, addresses, start_pid):
+    """ count (user, address, amount, pid) payouts spread over a pool of
+    addresses """
+    pool = [b58check(ADDRESS_VERSION,
+                     hashlib.sha256('{}{}'.format(currency, i)).digest()[:20])
+            for i in xrange(min(addresses, count))]
+    return [('user{}'.format(i % len(pool)), pool[i % len(pool)],
+             '0.{:08d}'.format(100000 + i % 1000000), start_pid + i)
+            for i in xrange(count)]
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class FakeSC(object):
+    """ The parts of the SimpleCoin server the client talks to. Payouts stay
+    in get_payouts until they're associated, and transactions stay
+    unconfirmed until confirm_transactions is posted """
+    def __init__(self, serializer, payouts):
+        self.serializer = serializer
+        self.lock = threading.Lock()
+        # currency -> list of payouts, sorted by pid
+        self.payouts = payouts
+        self.associated = set()
+        # txid -> currency
+        self.unconfirmed = {}
+
+    def get_payouts(self, data):
+        with self.lock:
+            pending = [p for p in self.payouts[data['currency']]
+                       if p[3] not in self.associated and
+                       p[3] > data.get('since_pid', -1)]
+        if 'limit' not in data:
+            return {'pids': pending}
+        start = data.get('cursor') or 0
+        end = start + data['limit']
+        return {'pids': pending[start:end],
+                'next_cursor': end if end < len(pending) else None}
+
+    def associate_payouts(self, data):
+        with self.lock:
+            self.associated.update(int(pid) for pid in data['pids'])
+            self.unconfirmed[data['coin_txid']] = data['currency']
+        return {'result': True}
+
+    def confirm_transactions(self, data):
+        with self.lock:
+            for txid in data['tids']:
+                self.unconfirmed.pop(txid, None)
+        return {'result': True}
+
+    def transactions(self, filter_by):
+        with self.lock:
+            return {'success': True,
+                    'objects': [{'txid': txid} for txid, currency
+                                in self.unconfirmed.iteritems()
+                                if currency == filter_by['currency']]}
+
+    def handler(self):
+        sc = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.GzipFile(fileobj=StringIO(body)).read()
+                endpoint = self.path.rsplit('/', 1)[-1]
+                data = sc.serializer.loads(body)
+                self.reply(sc.serializer.dumps(getattr(sc, endpoint)(data)))
+
+            def do_GET(self):
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                filter_by = json.loads(query['__filter_by'][0])
+                self.reply(json.dumps(sc.transactions(filter_by)))
+
+        return Handler
+
+
+class FakeCoinserver(object):
+    """ A wallet that pays anything out of an effectively infinite balance.
+    Every currency uses the same daemon, with its own account """
+    def __init__(self, confirmations):
+        self.confirmations = confirmations
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.transactions = {}
+        self.txcount = itertools.count()
+
+    def getinfo(self):
+        return {'blocks': 1000, 'connections': 8}
+
+    def getblockcount(self):
+        return 1000
+
+    def getbalance(self, account=None, *args):
+        with self.lock:
+            return self.balances.setdefault(account, Decimal('100000000'))
+
+    def sendmany(self, account, amounts, *args):
+        total = sum(Decimal(str(amount)) for amount in amounts.itervalues())
+        with self.lock:
+            self.balances.setdefault(account, Decimal('100000000'))
+            self.balances[account] -= total
+            txid = hashlib.sha256(str(next(self.txcount))).hexdigest()
+            self.transactions[txid] = {'txid': txid, 'amount': -total,
+                                       'fee': Decimal('-0.0001'),
+                                       'blockhash': '0' * 64}
+        return txid
+
+    def gettransaction(self, txid):
+        with self.lock:
+            tx = dict(self.transactions[txid])
+        tx['confirmations'] = self.confirmations
+        return tx
+
+    def walletpassphrase(self, *args):
+        return None
+
+    def walletlock(self):
+        return None
+
+    def settxfee(self, fee):
+        return True
+
+    def dispatch(self, call):
+        try:
+            result = getattr(self, call['method'])(*call.get('params', []))
+        except (AttributeError, KeyError) as e:
+            return {'id': call.get('id'), 'result': None,
+                    'error': {'code': -5, 'message': str(e)}}
+        return {'id': call.get('id'), 'result': result, 'error': None}
+
+    def handler(self):
+        coin = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])),
+                                  parse_float=Decimal)
+                if isinstance(body, list):
+                    out = [coin.dispatch(call) for call in body]
+                else:
+                    out = coin.dispatch(body)
+                out = json.dumps(out, default=float)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        return Handler
+
+
+class Latencies(object):
+    """ Raw latency samples, so percentiles aren't limited to histogram
+    buckets """
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, name, func):
+        samples = self.samples.setdefault(name, [])
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(time.time() - start)
+        return timed
+
+    def wrap_remote(self, func):
+        def timed(url, method, *args, **kwargs):
+            name = 'sc.' + (kwargs.get('endpoint') or url)
+            return self.wrap(name, func)(url, method, *args, **kwargs)
+        return timed
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pct(p):
+        return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 3)
+    return {'count': len(samples), 'p50_ms': pct(0.5), 'p90_ms': pct(0.9),
+            'p99_ms': pct(0.99), 'max_ms': round(samples[-1] * 1000, 3)}
+
+
+def run_scale(args, payouts, currencies, queue):
+    """ Runs one scale in the current process and puts its report (or the
+    error that stopped it) on queue """
+    try:
+        queue.put(bench_scale(args, payouts, currencies))
+    except Exception:
+        logging.exception("Benchmark failed")
+        queue.put({'payouts': payouts, 'currencies': currencies,
+                   'error': traceback.format_exc()})
+
+
+def bench_scale(args, payouts, currencies):
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(getattr(logging, args.log_level))
+    serializer = (URLSafeTimedSerializer if args.extra.get('rpc_compress')
+                  else TimedSerializer)(SECRET)
+
+    codes = ['C{:02d}'.format(i) for i in xrange(currencies)]
+    per_currency = payouts // currencies
+    sc = FakeSC(serializer, {
+        code: make_payouts(code, per_currency, args.addresses, i * per_currency + 1)
+        for i, code in enumerate(codes)})
+    sc_server = serve(sc.handler())
+    coin_server = serve(FakeCoinserver(args.confirmations).handler())
+
+    tmp = tempfile.mkdtemp(prefix='sc_rpc_bench')
+    latencies = Latencies()
+    clients = []
+    http_session = None
+    try:
+        for code in codes:
+            cfg = {'currency_code': code,
+                   'valid_address_versions': [ADDRESS_VERSION],
+                   'rpc_signature': SECRET,
+                   'rpc_url': 'http://127.0.0.1:{}/'.format(sc_server.server_address[1]),
+                   'database_path': os.path.join(tmp, code + '.sqlite'),
+                   'http_cache_path': os.path.join(tmp, 'http_cache_'),
+                   'log_path': None,
+                   'min_confirms': 6,
+                   'coinserv': {'address': '127.0.0.1',
+                                'port': coin_server.server_address[1],
+                                'username': 'bench', 'password': 'bench',
+                                'wallet_pass': '', 'account': code}}
+            cfg.update(args.extra)
+            client = SCRPCClient(cfg, CoinRPC(cfg, logger=logger), logger=logger,
+                                 http_session=http_session)
+            http_session = client.http
+
+            client._request = latencies.wrap_remote(client._request)
+            client.batch_rpc._post = latencies.wrap('coin.batch_rpc',
+                                                    client.batch_rpc._post)
+            for name in ('poke_rpc', 'get_balance', 'send_many'):
+                setattr(client.coin_rpc, name,
+                        latencies.wrap('coin.' + name, getattr(client.coin_rpc, name)))
+            clients.append(client)
+
+        pool = ThreadPool(args.workers or currencies)
+        phases = {}
+        for phase in ('pull_payouts', 'send_payout', 'associate_all', 'confirm_trans'):
+            def timed(client):
+                start = time.time()
+                getattr(client, phase)()
+                return time.time() - start
+
+            start = time.time()
+            durations = pool.map(timed, clients)
+            wall = time.time() - start
+            phases[phase] = dict(percentiles(durations),
+                                 seconds=round(wall, 3),
+                                 payouts_per_s=round(payouts / wall, 1))
+        pool.close()
+
+        unassociated = sum(1 for p in itertools.chain(*sc.payouts.values())
+                           if p[3] not in sc.associated)
+        return {
+            'payouts': per_currency * currencies,
+            'currencies': currencies,
+            'addresses': args.addresses,
+            'settings': args.extra,
+            'phases': phases,
+            'requests': {name: percentiles(samples)
+                         for name, samples in latencies.samples.iteritems()},
+            'unassociated': unassociated,
+            'unconfirmed_txns': len(sc.unconfirmed),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='payout benchmark')
+    parser.add_argument('--payouts', type=int, nargs='+', default=[1000, 100000],
+                        help='total payouts, split between the currencies')
+    parser.add_argument('--currencies', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--addresses', type=int, default=2000,
+                        help='distinct payout addresses per currency')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='currencies processed at once, default all')
+    parser.add_argument('--confirmations', type=int, default=120)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra sc_rpc_client config')
+    parser.add_argument('--log-level', default='WARN',
+                        choices=['DEBUG', 'INFO', 'WARN', 'ERROR'])
+    args = parser.parse_args()
+    args.extra = {}
+    for setting in args.set:
+        key, value = setting.split('=', 1)
+        args.extra[key] = yaml.safe_load(value)
+
+    logging.basicConfig()
+    for payouts in args.payouts:
+        for currencies in args.currencies:
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=run_scale,
+                                           args=(args, payouts, currencies, queue))
+            proc.start()
+            report = queue.get()
+            proc.join()
+            print(json.dumps(report, sort_keys=True))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures sign/verify throughput and wire size of the plain and compressed SC
+RPC serializers for pid lists of increasing size.
+
+    python benchmarks/serializer.py --sizes 100 1000 10000 100000
+
+Prints one JSON object per (serializer, size) pair.
+"""
+import argparse
+import json
+import time
+
+from itsdangerous import TimedSerializer, URLSafeTimedSerializer
+
+
+SERIALIZERS = {'plain': TimedSerializer,
+               'compressed': URLSafeTimedSerializer}
+
+
+def payload(size):
+    """ An associate_payouts style body with size pids """
+    return {'coin_txid': '1' * 64,
+            'pids': [str(10000000 + i) for i in xrange(size)],
+            'tx_fee': 0.0001,
+            'currency': 'LTC'}
+
+
+def bench(serializer, data, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        signed = serializer.dumps(data)
+    dumps_time = (time.time() - start) / repeat
+
+    start = time.time()
+    for _ in xrange(repeat):
+        serializer.loads(signed, max_age=60)
+    loads_time = (time.time() - start) / repeat
+    return signed, dumps_time, loads_time
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='serializer benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        data = payload(size)
+        raw_bytes = len(json.dumps(data))
+        for name, cls in sorted(SERIALIZERS.items()):
+            signed, dumps_time, loads_time = bench(cls('secret'), data, args.repeat)
+            print(json.dumps({
+                'serializer': name,
+                'pids': size,
+                'json_bytes': raw_bytes,
+                'wire_bytes': len(signed),
+                'dumps_ms': round(dumps_time * 1000, 3),
+                'loads_ms': round(loads_time * 1000, 3),
+                'dumps_mb_s': round(raw_bytes / dumps_time / 1e6, 2),
+                'loads_mb_s': round(raw_bytes / loads_time / 1e6, 2),
+            }, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
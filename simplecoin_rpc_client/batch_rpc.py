@@ -0,0 +1,151 @@
+import json
+import logging
+
+from decimal import Decimal
+from multiprocessing.pool import ThreadPool
+from cryptokit.rpc import CoinRPCException
+from simplecoin_rpc_client import metrics
+
+
+class BatchUnsupported(Exception):
+    pass
+
+
+class BatchTransaction(object):
+    """ The parts of a gettransaction result that we care about, with the
+    same attribute names as the objects returned by CoinRPC.get_transaction """
+    def __init__(self, txid, data):
+        self.txid = txid
+        self.data = data
+        self.confirmations = data.get('confirmations', 0)
+        self.blockhash = data.get('blockhash')
+        self.fee = Decimal(str(data.get('fee', 0)))
+
+
+class BatchRPC(object):
+    """ Talks JSON-RPC directly to a coinserver using the connection details
+    of a CoinRPC handle, so that many calls can be sent as one JSON-RPC batch
+    array over a pooled keep-alive connection.
+
+    Daemons that reject batch arrays are detected on first use, after which
+    lookups fall back to bounded parallel single calls. """
+    def __init__(self, coin_rpc, batch_size=50, workers=4, use_batch=True,
+                 timeout=60, logger=None, currency=None):
+        coinserv = coin_rpc.coinserv
+        self.url = "http://{}:{}/".format(coinserv['address'], coinserv['port'])
+        self.auth = (coinserv['username'], coinserv['password'])
+        self.batch_size = batch_size
+        self.workers = workers
+        self.use_batch = use_batch
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.currency = currency
+        self._http = None
+
+    @property
+    def http(self):
+        """ Keep-alive session to the coinserver, built on first use """
+        if self._http is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self._http = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            self._http.mount('http://', adapter)
+        return self._http
+
+    def _post(self, payload):
+        import requests
+
+        method = 'batch' if isinstance(payload, list) else payload['method']
+        try:
+            with metrics.registry.timer('coin_rpc_request', method=method,
+                                        currency=self.currency):
+                ret = self.http.post(self.url, data=json.dumps(payload),
+                                     auth=self.auth, timeout=self.timeout,
+                                     headers={'Content-Type': 'application/json'})
+        except requests.exceptions.RequestException as e:
+            raise CoinRPCException("Unable to connect to coinserver: {}".format(e))
+
+        try:
+            return ret.json(parse_float=Decimal)
+        except ValueError:
+            raise CoinRPCException("Non JSON response from coinserver ({}): {}"
+                                   .format(ret.status_code, ret.text))
+
+    def call(self, method, *params):
+        """ Makes a single JSON-RPC call and returns its result """
+        res = self._post({'version': '1.1', 'id': 0, 'method': method,
+                          'params': list(params)})
+        if res.get('error'):
+            raise CoinRPCException(res['error'])
+        return res['result']
+
+    def batch(self, calls):
+        """ Sends a list of (method, params) as one JSON-RPC batch. Returns a
+        list of (result, error) in the same order as calls. Raises
+        BatchUnsupported if the daemon doesn't understand batch arrays. """
+        payload = [{'version': '1.1', 'id': i, 'method': method,
+                    'params': list(params)}
+                   for i, (method, params) in enumerate(calls)]
+        res = self._post(payload)
+        if not isinstance(res, list):
+            raise BatchUnsupported(res.get('error') if isinstance(res, dict) else res)
+
+        out = [(None, CoinRPCException("No response in batch"))] * len(calls)
+        for item in res:
+            if item.get('error'):
+                out[item['id']] = (None, CoinRPCException(item['error']))
+            else:
+                out[item['id']] = (item['result'], None)
+        return out
+
+    def get_transactions(self, txids):
+        """ Looks up many wallet transactions at once. Returns two dicts
+        keyed by txid, the first of BatchTransaction objects and the second
+        of CoinRPCExceptions for any txids that failed. """
+        txids = list(set(txids))
+        found = {}
+        errors = {}
+
+        if self.use_batch:
+            for i in xrange(0, len(txids), self.batch_size):
+                chunk = txids[i:i + self.batch_size]
+                try:
+                    results = self.batch([('gettransaction', [txid]) for txid in chunk])
+                except BatchUnsupported as e:
+                    self.logger.warn("Coinserver rejected a batch request ({}), "
+                                     "falling back to single calls".format(e))
+                    self.use_batch = False
+                    break
+                except CoinRPCException as e:
+                    for txid in chunk:
+                        errors[txid] = e
+                    continue
+
+                for txid, (result, error) in zip(chunk, results):
+                    if error is not None:
+                        errors[txid] = error
+                    else:
+                        found[txid] = BatchTransaction(txid, result)
+
+        remaining = [txid for txid in txids
+                     if txid not in found and txid not in errors]
+        if remaining:
+            def lookup(txid):
+                try:
+                    return txid, BatchTransaction(txid, self.call('gettransaction', txid)), None
+                except CoinRPCException as e:
+                    return txid, None, e
+
+            pool = ThreadPool(min(self.workers, len(remaining)))
+            try:
+                for txid, tx, error in pool.map(lookup, remaining):
+                    if error is not None:
+                        errors[txid] = error
+                    else:
+                        found[txid] = tx
+            finally:
+                pool.close()
+
+        return found, errors
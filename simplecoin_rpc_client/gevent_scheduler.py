@@ -0,0 +1,67 @@
+"""
+Runs the payout scheduler on a gevent event loop instead of APScheduler's
+thread pool. Every socket the client uses (SC requests, coinserver JSON-RPC)
+becomes cooperative, so one process can drive many currencies and hundreds of
+concurrent lookups without a thread for each. Requires gevent to be
+installed.
+
+Note that sqlite calls still block the loop while they run, so keep
+db_busy_timeout low when running this way.
+"""
+from gevent import monkey
+# Must happen before anything else imports socket, threading etc.
+monkey.patch_all()
+
+import datetime
+import gevent
+import setproctitle
+
+from apscheduler.triggers.cron import CronTrigger
+from simplecoin_rpc_client.scheduler import logger, setup, add_jobs
+
+
+class GeventScheduler(object):
+    """ A small cron scheduler that runs each job in its own greenlet. Takes
+    the same add_cron_job arguments as apscheduler's Scheduler, and like it
+    skips a run if the previous run of the job is still going. """
+    def __init__(self):
+        self.jobs = []
+
+    def add_cron_job(self, func, **fields):
+        self.jobs.append((func, CronTrigger(**fields)))
+
+    def _run_job(self, func, trigger):
+        running = None
+        while True:
+            now = datetime.datetime.now()
+            # Cron fields have a resolution of one second, so look from the
+            # start of the next second to avoid firing twice
+            next_run = trigger.get_next_fire_time(
+                now.replace(microsecond=0) + datetime.timedelta(seconds=1))
+            gevent.sleep((next_run - now).total_seconds())
+
+            if running is not None and not running.ready():
+                logger.warn("Skipping run of {}, the previous run is still going"
+                            .format(func.__name__))
+                continue
+            running = gevent.spawn(func)
+
+    def start(self):
+        gevent.joinall([gevent.spawn(self._run_job, func, trigger)
+                        for func, trigger in self.jobs])
+
+
+def entry():
+    pm = setup('simplecoin rpc client gevent scheduler')
+
+    sched = GeventScheduler()
+    logger.info("=" * 80)
+    logger.info("SimpleCoin gevent cron scheduler starting up...")
+    setproctitle.setproctitle("simplecoin_scheduler")
+
+    add_jobs(sched, pm)
+
+    sched.start()
+
+if __name__ == "__main__":
+    entry()
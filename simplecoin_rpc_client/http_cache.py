@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+
+
+class HTTPCache(object):
+    """ Keeps the last response body for each URL, along with the ETag and
+    Last-Modified validators needed to revalidate it with a conditional GET.
+
+    Entries are written to a JSON file at path so that they survive between
+    runs (manage.py, restarts), or only held in memory if path is None. The
+    parsed body of an entry is kept in memory as well, so an unchanged
+    response is only parsed once per process.
+
+    New and revalidated entries are staged until commit(url) is called, so
+    that a caller can hold off caching a response until it has committed
+    whatever it did with it. """
+    def __init__(self, path=None, ttl=0):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._entries = None
+        self.pending = {}
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        self._entries = json.load(f)
+                except ValueError:
+                    # A corrupt cache only costs a full fetch
+                    pass
+        return self._entries
+
+    def get(self, url):
+        """ The entry for url or None """
+        with self.lock:
+            return self.entries.get(url)
+
+    def fresh(self, entry):
+        """ Whether entry is young enough to be used without revalidating """
+        return time.time() - entry['fetched'] < self.ttl
+
+    @staticmethod
+    def validators(entry):
+        """ The conditional request headers for revalidating entry """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response, data):
+        """ Stages a 200 response and its parsed body """
+        entry = {'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified'),
+                 'body': response.text,
+                 'fetched': time.time(),
+                 'data': data}
+        with self.lock:
+            self.pending[url] = entry
+        return entry
+
+    def touch(self, url, entry):
+        """ Stages an entry the server said is unchanged, restarting its
+        TTL """
+        entry = dict(entry, fetched=time.time())
+        with self.lock:
+            self.pending[url] = entry
+        return entry
+
+    def commit(self, url):
+        """ Caches the response staged for url, if any """
+        with self.lock:
+            entry = self.pending.pop(url, None)
+            if entry is not None:
+                self.entries[url] = entry
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        # Write then rename, so a crash mid write doesn't lose the cache
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({url: {k: v for k, v in entry.iteritems() if k != 'data'}
+                       for url, entry in self.entries.iteritems()}, f)
+        os.rename(tmp, self.path)
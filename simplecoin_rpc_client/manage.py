@@ -3,11 +3,9 @@ import os
 import argparse
 import yaml
 
-from cryptokit.rpc_wrapper import CoinRPC
-from simplecoin_rpc_client.sc_rpc import SCRPCClient
-
 logger = logging.getLogger('apscheduler.scheduler')
 os_root = os.path.abspath(os.path.dirname(__file__) + '/../')
+CONSTANTS = {'True': True, 'False': False, 'None': None}
 
 
 def entry():
@@ -45,26 +43,36 @@ def entry():
     # =========================================================================
     cfg = yaml.load(open(os_root + args.config_location))
 
-    # Setup our CoinRPCs + SCRPCClients
-    coin_rpc = {}
-    sc_rpc = {}
+    # Only build the CoinRPC + SCRPCClient for the currency we were asked
+    # about, the others would just slow down startup
     for curr_cfg in cfg['currencies']:
-
-        if not curr_cfg['enabled']:
-            continue
-
-        cc = curr_cfg['currency_code']
-        coin_rpc[cc] = CoinRPC(curr_cfg, logger=logger)
-
-        curr_cfg.update(cfg['sc_rpc_client'])
-        sc_rpc[cc] = SCRPCClient(curr_cfg, coin_rpc[cc], logger=logger)
-
+        if curr_cfg['enabled'] and curr_cfg['currency_code'] == args.currencycode:
+            break
+    else:
+        parser.error("{} is not an enabled currency in {}"
+                     .format(args.currencycode, args.config_location))
+
+    # Imported here so that argument errors and --help return quickly
+    from cryptokit.rpc_wrapper import CoinRPC
+    from simplecoin_rpc_client.sc_rpc import SCRPCClient
+
+    coin_rpc = CoinRPC(curr_cfg, logger=logger)
+    curr_cfg.update(cfg['sc_rpc_client'])
+    sc_rpc = SCRPCClient(curr_cfg, coin_rpc, logger=logger)
+
+    # -a takes positional arguments, and key=value pairs that are passed as
+    # keyword arguments, eg. -a simulate=True or -a format=csv limit=100
     function_args = []
-    if hasattr(args, 'args'):
-        function_args = args.args or []
-
-    function = getattr(sc_rpc[args.currencycode], args.function)
-    function(*function_args)
+    function_kwargs = {}
+    for arg in args.args or []:
+        key, sep, value = arg.partition('=')
+        if sep:
+            function_kwargs[key] = CONSTANTS.get(value, value)
+        else:
+            function_args.append(arg)
+
+    function = getattr(sc_rpc, args.function)
+    function(*function_args, **function_kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+import os
+import time
+import threading
+
+from contextlib import contextmanager
+
+
+# Upper bounds (seconds) for latency histograms. Cover everything from a
+# local sqlite commit up to a sendmany that takes minutes
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, 600)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry(object):
+    """ Thread safe store of counters, gauges and latency histograms, keyed
+    by metric name and a set of labels. Renders to the Prometheus text format.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Records how long the block took in the name_seconds histogram,
+        and counts exceptions it raises in name_errors_total """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.inc(name + '_errors_total', **labels)
+            raise
+        finally:
+            self.observe(name + '_seconds', time.time() - start, **labels)
+
+    def render(self):
+        def fmt(name, labels, value):
+            if labels:
+                name += '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+            return '{} {}'.format(name, repr(float(value)))
+
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(n for n, _ in values)):
+                    lines.append('# TYPE {} {}'.format(name, kind))
+                    for (n, labels), value in sorted(values.items()):
+                        if n == name:
+                            lines.append(fmt(name, labels, value))
+
+            for name in sorted(set(n for n, _ in self.histograms)):
+                lines.append('# TYPE {} histogram'.format(name))
+                for (n, labels), hist in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        lines.append(fmt(name + '_bucket',
+                                         labels + (('le', repr(float(bound))),), count))
+                    lines.append(fmt(name + '_bucket', labels + (('le', '+Inf'),),
+                                     hist.count))
+                    lines.append(fmt(name + '_sum', labels, hist.sum))
+                    lines.append(fmt(name + '_count', labels, hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class TimedProxy(object):
+    """ Wraps an object (eg. a CoinRPC) so every method call is timed into
+    registry under name, labelled with the method name """
+    def __init__(self, obj, name, **labels):
+        self._obj = obj
+        self._name = name
+        self._labels = labels
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        if not callable(value):
+            return value
+
+        def timed(*args, **kwargs):
+            with registry.timer(self._name, method=attr, **self._labels):
+                return value(*args, **kwargs)
+        return timed
+
+
+def serve(address, port):
+    """ Serves the Prometheus text format from a daemon thread """
+    import BaseHTTPServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_periodically(path, interval):
+    """ Rewrites path with the Prometheus text format every interval seconds
+    from a daemon thread, for node_exporter's textfile collector """
+    def write():
+        while True:
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(registry.render())
+            os.rename(tmp, path)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=write)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,102 @@
+import sys
+import threading
+
+
+class PidIndex(object):
+    """ The set of payout pids already in a currency's database (live or
+    archived), so that pull_payouts only has to ask SQLite about pids it
+    hasn't seen.
+
+    Pids only ever enter the database through pull_payouts and are only
+    deleted by init_db, which clears the index (archiving moves them to the
+    archive table, which is checked too), so a hit is exact. A miss may
+    still be a pid another process inserted, and must be confirmed against
+    the database.
+
+    Numeric pids are held as ints, which take a fraction of the memory of
+    the text they're stored as. If the estimated size grows past max_bytes
+    the index is dropped for the life of the process and every lookup goes
+    to the database again. """
+    def __init__(self, max_bytes, logger=None, name=''):
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.name = name
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Forgets every pid, so the index is loaded again on next use """
+        self.pids = None
+        self.element_bytes = 0
+        self.disabled = not self.max_bytes
+
+    @staticmethod
+    def key(pid):
+        pid = unicode(pid)
+        # Leave pids like 007 as text, so they don't collide with 7
+        if pid.isdigit() and unicode(int(pid)) == pid:
+            return int(pid)
+        return pid
+
+    @property
+    def warm(self):
+        return self.pids is not None
+
+    @property
+    def size_bytes(self):
+        """ Estimated memory used by the set and the pids in it """
+        if self.pids is None:
+            return 0
+        return sys.getsizeof(self.pids) + self.element_bytes
+
+    def load(self, pids):
+        """ Fills the index from an iterable of every known pid """
+        with self.lock:
+            if self.disabled:
+                return
+            self.pids = set()
+            self.element_bytes = 0
+            self._add(pids)
+            if not self.disabled and self.logger:
+                self.logger.info("Indexed {:,} known {} pids in {:,} KB"
+                                 .format(len(self.pids), self.name,
+                                         self.size_bytes // 1024))
+
+    def update(self, pids):
+        """ Adds newly inserted pids """
+        with self.lock:
+            if self.pids is not None:
+                self._add(pids)
+
+    def _add(self, pids):
+        for i, pid in enumerate(pids):
+            pid = self.key(pid)
+            if pid not in self.pids:
+                self.pids.add(pid)
+                self.element_bytes += sys.getsizeof(pid)
+            # Checking the size is cheap, but not free
+            if not i % 1024 and self.size_bytes > self.max_bytes:
+                return self._disable()
+        if self.size_bytes > self.max_bytes:
+            self._disable()
+
+    def _disable(self):
+        if self.logger:
+            self.logger.warn("{} pid index passed its {:,} KB limit at {:,} pids, "
+                             "checking pids against the database instead"
+                             .format(self.name, self.max_bytes // 1024,
+                                     len(self.pids)))
+        self.pids = None
+        self.element_bytes = 0
+        self.disabled = True
+
+    def split(self, pids):
+        """ Splits pids into (known, unknown) lists. Everything is unknown
+        while the index is cold or disabled """
+        with self.lock:
+            if self.pids is None:
+                return [], list(pids)
+            known, unknown = [], []
+            for pid in pids:
+                (known if self.key(pid) in self.pids else unknown).append(pid)
+            return known, unknown
@@ -0,0 +1,92 @@
+import csv
+import datetime
+import json
+import sys
+
+from tabulate import tabulate
+
+
+FORMATS = ('table', 'csv', 'jsonl')
+DEFAULT_COLUMNS = ["pid", "user", "address", "amount_float", "associated",
+                   "locked", "trans_id"]
+
+
+def parse_time(value):
+    """ Accepts a date/datetime, or a string in YYYY-MM-DD or
+    YYYY-MM-DD HH:MM:SS form as given on the command line """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Can't parse {!r} as a date".format(value))
+
+
+class ReportWriter(object):
+    """ Writes report sections a row at a time, so that memory use doesn't
+    depend on the number of rows.
+
+    table prints each section as grid tables of at most page_size rows. csv
+    and jsonl write one row per line with a leading report column naming
+    the section, and a single header line for csv. """
+    def __init__(self, format='table', columns=None, output=None, page_size=1000):
+        if format not in FORMATS:
+            raise ValueError("Unknown report format {}, expected one of {}"
+                             .format(format, ", ".join(FORMATS)))
+        self.format = format
+        self.columns = columns or DEFAULT_COLUMNS
+        self.page_size = page_size
+        self.out = open(output, 'wb') if output else sys.stdout
+        self.close_out = bool(output)
+        if format == 'csv':
+            self.csv = csv.writer(self.out)
+            self.csv.writerow(['report'] + self.columns)
+
+    def section(self, title, rows):
+        """ Writes rows, an iterable of value lists in column order, under
+        title. Returns the number of rows written """
+        if self.format == 'table':
+            return self._table(title, rows)
+
+        count = 0
+        for row in rows:
+            if self.format == 'csv':
+                self.csv.writerow([title] + [self._csv_value(v) for v in row])
+            else:
+                data = dict(zip(self.columns, row))
+                data['report'] = title
+                self.out.write(json.dumps(data, default=str, sort_keys=True) + '\n')
+            count += 1
+        return count
+
+    def _table(self, title, rows):
+        self.out.write("@@ {} @@\n".format(title))
+        count = 0
+        page = []
+        for row in rows:
+            page.append(row)
+            count += 1
+            if len(page) >= self.page_size:
+                self.out.write(tabulate(page, headers=self.columns, tablefmt="grid") + "\n")
+                page = []
+        if page:
+            self.out.write(tabulate(page, headers=self.columns, tablefmt="grid") + "\n")
+        if not count:
+            self.out.write("-- Nothing to display --\n")
+        self.out.write("\n")
+        return count
+
+    @staticmethod
+    def _csv_value(value):
+        if isinstance(value, unicode):
+            return value.encode('utf8')
+        return value
+
+    def close(self):
+        self.out.flush()
+        if self.close_out:
+            self.out.close()
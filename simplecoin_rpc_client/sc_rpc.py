@@ -1,37 +1,116 @@
 import logging
 from pprint import pformat
+from decimal import Decimal, ROUND_HALF_UP
+from StringIO import StringIO
 import sys
-import yaml
 import os
-import argparse
 import datetime
-import requests
+import time
+import gzip
+import json
+import threading
+import decorator
 import sqlalchemy as sa
 
+from contextlib import contextmanager
 from cryptokit.rpc import CoinRPCException
-from urllib3.exceptions import ConnectionError
-from tabulate import tabulate
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from multiprocessing.pool import ThreadPool
 
 from urlparse import urljoin
 from cryptokit.base58 import get_bcaddress_version
-from itsdangerous import TimedSerializer, BadData
+from itsdangerous import TimedSerializer, URLSafeTimedSerializer, BadData
+from simplecoin_rpc_client.batch_rpc import BatchRPC
+from simplecoin_rpc_client.http_cache import HTTPCache
+from simplecoin_rpc_client.pid_index import PidIndex
+from simplecoin_rpc_client import metrics
 
 
 base = declarative_base()
+SATOSHIS = Decimal(100000000)
+# Rough sizes for estimating how big a sendmany transaction will be
+TX_OVERHEAD_BYTES = 10
+TX_OUTPUT_BYTES = 34
 
 
-class Payout(base):
-    """ Our single table in the sqlite database. Handles tracking the status of
-    payouts and keeps track of tasks that needs to be retried, etc. """
-    __tablename__ = "payouts"
+def to_satoshis(amount):
+    """ Converts a coin amount (str, float or Decimal) to an integer number
+    of base units """
+    return int((Decimal(str(amount)) * SATOSHIS)
+               .quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_satoshis(amount_sat):
+    """ Converts an integer number of base units to a float coin amount """
+    return float(Decimal(amount_sat) / SATOSHIS)
+
+
+def chunks(seq, size):
+    """ Yields successive slices of seq no longer than size. Used to keep
+    IN (...) lookups under SQLite's bound parameter limit. """
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+@decorator.decorator
+def busy_retry(func, self, *args, **kwargs):
+    """ Rolls back and retries a method that failed because another process
+    held the payout database locked for longer than db_busy_timeout. Only use
+    it on methods that are safe to run again from the start. """
+    attempt = 0
+    while True:
+        try:
+            return func(self, *args, **kwargs)
+        except sa.exc.OperationalError as e:
+            self.db.session.rollback()
+            attempt += 1
+            if 'database is locked' not in str(e) or attempt > self.config['db_busy_retries']:
+                raise
+            self.logger.warn("{} database busy during {}, retrying ({}/{})"
+                             .format(self.config['currency_code'], func.__name__,
+                                     attempt, self.config['db_busy_retries']))
+            time.sleep(self.config['db_retry_delay'])
+
+
+def make_http_session(pool_size):
+    """ Builds a keep-alive requests Session with a connection pool of
+    pool_size connections per host. One Session can be shared by every
+    SCRPCClient in a process. """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def tabulate(*args, **kwargs):
+    """ tabulate.tabulate, imported on first use since only the reports
+    and payout summaries need it """
+    from tabulate import tabulate
+    return tabulate(*args, **kwargs)
+
+
+def gzip_body(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class PayoutColumns(object):
+    """ The columns and helpers shared by live and archived payouts """
     id = sa.Column(sa.Integer, primary_key=True)
     pid = sa.Column(sa.String, unique=True, nullable=False)
     user = sa.Column(sa.String, nullable=False)
     address = sa.Column(sa.String, nullable=False)
     # SQLlite does not have support for Decimal - use STR instead
     amount = sa.Column(sa.String, nullable=False)
+    # The same amount in integer base units, which SQL can sum and index
+    amount_sat = sa.Column(sa.BigInteger)
     currency_code = sa.Column(sa.String, nullable=False)
     txid = sa.Column(sa.String)
     associated = sa.Column(sa.Boolean, default=False, nullable=False)
@@ -42,6 +121,8 @@ class Payout(base):
     paid_time = sa.Column(sa.DateTime)
     assoc_time = sa.Column(sa.DateTime)
     pull_time = sa.Column(sa.DateTime)
+    # When SC accepted the transaction as confirmed
+    confirm_time = sa.Column(sa.DateTime)
 
     @property
     def trans_id(self):
@@ -51,11 +132,57 @@ class Payout(base):
 
     @property
     def amount_float(self):
-        return float(self.amount)
+        if self.amount_sat is None:
+            return float(self.amount)
+        return from_satoshis(self.amount_sat)
 
     def tabulize(self, columns):
         return [getattr(self, a) for a in columns]
 
+    @classmethod
+    def tabulize_row(cls, row, columns):
+        """ tabulize for a plain row of payout columns, such as a tuple from a
+        column query, working out the computed columns from it """
+        return [getattr(cls, a).fget(row) if isinstance(getattr(cls, a, None), property)
+                else getattr(row, a) for a in columns]
+
+
+class Payout(PayoutColumns, base):
+    """ Our main table in the sqlite database. Handles tracking the status of
+    payouts and keeps track of tasks that needs to be retried, etc. """
+    __tablename__ = "payouts"
+
+
+class ArchivedPayout(PayoutColumns, base):
+    """ Cold storage for payouts that are paid, associated and confirmed, so
+    they stop slowing down queries on the live payouts table. Lives in its
+    own file, attached to every connection as the archive schema. """
+    __tablename__ = "payouts_archive"
+    __table_args__ = {'schema': 'archive'}
+    archive_time = sa.Column(sa.DateTime)
+
+
+class Transaction(base):
+    """ Tracks the confirmation progress of our payout transactions, so
+    confirm_trans only asks the coinserver about the ones due a check. """
+    __tablename__ = "transactions"
+    txid = sa.Column(sa.String, primary_key=True)
+    confirmations = sa.Column(sa.Integer, default=0, nullable=False)
+    block_height = sa.Column(sa.Integer)
+    last_check = sa.Column(sa.DateTime)
+    next_check = sa.Column(sa.DateTime)
+    # confirmed on the network, and whether SC has been told yet
+    confirmed = sa.Column(sa.Boolean, default=False, nullable=False)
+    pushed = sa.Column(sa.Boolean, default=False, nullable=False)
+
+
+class State(base):
+    """ Small key/value store for client bookkeeping that has to survive
+    restarts, such as the payout pull watermark. """
+    __tablename__ = "state"
+    key = sa.Column(sa.String, primary_key=True)
+    value = sa.Column(sa.String)
+
 
 class SCRPCException(Exception):
     pass
@@ -71,11 +198,51 @@ class SCRPCClient(object):
                            database_path=base + '/rpc_',
                            log_path=base + '/sc_rpc.log',
                            min_confirms=12,
-                           minimum_tx_output=0.00000001)
+                           minimum_tx_output=0.00000001,
+                           db_chunk_size=500,
+                           http_pool_size=10,
+                           connect_timeout=10,
+                           read_timeout=270,
+                           endpoint_timeouts={},
+                           gzip_requests=False,
+                           tx_batch=True,
+                           tx_batch_size=50,
+                           tx_lookup_workers=4,
+                           coin_rpc_timeout=60,
+                           incremental_pull=False,
+                           full_pull_interval=3600,
+                           pull_page_size=0,
+                           pid_index_max_mb=64,
+                           db_wal=True,
+                           db_busy_timeout=30,
+                           db_busy_retries=3,
+                           db_retry_delay=5,
+                           archive_path=None,
+                           archive_after_days=30,
+                           vacuum_interval_days=7,
+                           assoc_chunk_size=1000,
+                           assoc_workers=4,
+                           block_interval=600,
+                           rpc_compress=False,
+                           max_tx_outputs=500,
+                           max_tx_bytes=100000,
+                           tx_input_bytes=20000,
+                           confirm_mode='poll',
+                           blocknotify_file=None,
+                           http_cache_path=base + '/http_cache_',
+                           http_cache_ttl=0)
         self.config.update(kwargs)
 
         # Kinda sloppy, but it works
         self.config['database_path'] += self.config['currency_code'] + '.sqlite'
+        if self.config['archive_path']:
+            self.config['archive_path'] += self.config['currency_code'] + '.sqlite'
+        else:
+            # Next to the payout database unless told otherwise
+            self.config['archive_path'] = (
+                self.config['database_path'][:-len('.sqlite')] + '_archive.sqlite')
+        if self.config['http_cache_path']:
+            self.config['http_cache_path'] += self.config['currency_code'] + '.json'
 
         required_conf = ['valid_address_versions', 'currency_code',
                          'rpc_signature', 'rpc_url']
@@ -88,40 +255,12 @@ class SCRPCClient(object):
         if error:
             raise SCRPCException('Errors occurred while configuring RPCClient obj')
 
-    def __init__(self, config, CoinRPC, logger=None):
+    def __init__(self, config, CoinRPC, logger=None, http_session=None):
 
         if not config:
             raise SCRPCException('Invalid configuration file')
         self._set_config(**config)
 
-        # Setup CoinRPC
-        self.coin_rpc = CoinRPC
-
-        # Setup the sqlite database mapper
-        self.engine = sa.create_engine('sqlite:///{}'.format(self.config['database_path']),
-                                       echo=self.config['log_level'] == "DEBUG")
-
-        # Pulled from SQLA docs to implement strict exclusive access to the
-        # payout state database.
-        # See http://docs.sqlalchemy.org/en/rel_0_9/dialects/sqlite.html#pysqlite-serializable
-        @sa.event.listens_for(self.engine, "connect")
-        def do_connect(dbapi_connection, connection_record):
-            # disable pysqlite's emitting of the BEGIN statement entirely.
-            # also stops it from emitting COMMIT before any DDL.
-            dbapi_connection.isolation_level = None
-
-        @sa.event.listens_for(self.engine, "begin")
-        def do_begin(conn):
-            # emit our own BEGIN
-            conn.execute("BEGIN EXCLUSIVE")
-
-        self.db = sessionmaker(bind=self.engine)
-        self.db.session = self.db()
-        # Hack if flask is in the env
-        self.db.session._model_changes = {}
-        # Create the table if it doesn't exist
-        Payout.__table__.create(self.engine, checkfirst=True)
-
         # Setup logger for the class
         if logger:
             self.logger = logger
@@ -144,7 +283,88 @@ class SCRPCClient(object):
                 handler.setLevel(getattr(logging, self.config['log_level']))
                 self.logger.addHandler(handler)
 
-        self.serializer = TimedSerializer(self.config['rpc_signature'])
+        # Setup CoinRPC, timing every call into the metrics registry
+        self.coin_rpc = metrics.TimedProxy(CoinRPC, 'coin_rpc_request',
+                                           currency=self.config['currency_code'])
+        # Batched JSON-RPC for bulk lookups against the same coinserver
+        self.batch_rpc = BatchRPC(self.coin_rpc,
+                                  batch_size=self.config['tx_batch_size'],
+                                  workers=self.config['tx_lookup_workers'],
+                                  use_batch=self.config['tx_batch'],
+                                  timeout=self.config['coin_rpc_timeout'],
+                                  logger=self.logger,
+                                  currency=self.config['currency_code'])
+
+        # Setup the sqlite database mapper
+        self.engine = sa.create_engine('sqlite:///{}'.format(self.config['database_path']),
+                                       echo=self.config['log_level'] == "DEBUG",
+                                       connect_args={'timeout': self.config['db_busy_timeout']})
+
+        # Pulled from SQLA docs to control the locking of transactions on the
+        # payout state database ourselves.
+        # See http://docs.sqlalchemy.org/en/rel_0_9/dialects/sqlite.html#pysqlite-serializable
+        @sa.event.listens_for(self.engine, "connect")
+        def do_connect(dbapi_connection, connection_record):
+            # disable pysqlite's emitting of the BEGIN statement entirely.
+            # also stops it from emitting COMMIT before any DDL.
+            dbapi_connection.isolation_level = None
+            dbapi_connection.execute("ATTACH DATABASE ? AS archive",
+                                     (self.config['archive_path'],))
+            # WAL lets readers (reports) run alongside a writer
+            if self.config['db_wal']:
+                dbapi_connection.execute("PRAGMA main.journal_mode=WAL")
+                dbapi_connection.execute("PRAGMA archive.journal_mode=WAL")
+
+        # The BEGIN mode for the current thread's transactions, see
+        # transaction_mode
+        self._txn = threading.local()
+
+        @sa.event.listens_for(self.engine, "begin")
+        def do_begin(conn):
+            # emit our own BEGIN
+            conn.execute("BEGIN " + getattr(self._txn, 'mode', 'IMMEDIATE'))
+            conn.info['txn_start'] = time.time()
+
+        # Record how long each transaction held the database
+        def txn_end(conn):
+            start = conn.info.pop('txn_start', None)
+            if start is not None:
+                metrics.registry.observe('db_transaction_seconds', time.time() - start,
+                                         currency=self.config['currency_code'])
+        sa.event.listen(self.engine, "commit", txn_end)
+        sa.event.listen(self.engine, "rollback", txn_end)
+
+        self.db = sessionmaker(bind=self.engine)
+        self.db.session = self.db()
+        # Hack if flask is in the env
+        self.db.session._model_changes = {}
+        # Create the tables if they don't exist and bring the schema up to date
+        self.migrate()
+        # pids already in the database, loaded at the first pull
+        self.known_pids = PidIndex(int(self.config['pid_index_max_mb'] * 1024 * 1024),
+                                   logger=self.logger,
+                                   name=self.config['currency_code'])
+
+        # The compressed serializer zlib compresses payloads before signing
+        # them. The SC server has to be configured to match
+        if self.config['rpc_compress']:
+            self.serializer = URLSafeTimedSerializer(self.config['rpc_signature'])
+        else:
+            self.serializer = TimedSerializer(self.config['rpc_signature'])
+
+        # Pooled keep-alive connections to SC, optionally shared with other
+        # clients. Built on first use so local only commands (reports,
+        # reset_all_locked etc.) don't import requests
+        self._http = http_session
+        # Responses to unsigned GETs, revalidated with conditional requests
+        self.http_cache = HTTPCache(self.config['http_cache_path'],
+                                    self.config['http_cache_ttl'])
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = make_http_session(self.config['http_pool_size'])
+        return self._http
 
     ########################################################################
     # Helper URL methods
@@ -153,54 +373,263 @@ class SCRPCClient(object):
         if 'data' not in kwargs:
             kwargs['data'] = ''
         kwargs['data'] = self.serializer.dumps(kwargs['data'])
-        return self.remote('/rpc/' + url, 'post', *args, **kwargs)
+        if self.config['gzip_requests']:
+            kwargs['data'] = gzip_body(kwargs['data'])
+            kwargs.setdefault('headers', {})['Content-Encoding'] = 'gzip'
+        return self.remote('/rpc/' + url, 'post', *args, endpoint=url, **kwargs)
 
     def get(self, url, *args, **kwargs):
-        return self.remote(url, 'get', *args, **kwargs)
-
-    def remote(self, url, method, max_age=None, signed=True, **kwargs):
+        return self.remote(url, 'get', *args, endpoint=url.split('?')[0], **kwargs)
+
+    def get_cached(self, url):
+        """ An unsigned get that goes through http_cache. A cached response
+        younger than http_cache_ttl is used as is, an older one is revalidated
+        with If-None-Match/If-Modified-Since.
+
+        Returns (data, modified), where modified is False if data is the
+        cached response. The response is only cached (or its TTL restarted)
+        once the caller calls http_cache.commit(url), which it should do after
+        committing whatever it did with the data """
+        endpoint = url.split('?')[0]
+        entry = self.http_cache.get(url)
+        if entry is not None:
+            if self.http_cache.fresh(entry):
+                self.logger.debug("Using cached {} response".format(endpoint))
+                return self._cached_data(entry), False
+            ret = self._request(url, 'get', endpoint=endpoint, not_modified_ok=True,
+                                headers=self.http_cache.validators(entry))
+            if ret.status_code == 304:
+                self.logger.debug("{} response unchanged".format(endpoint))
+                metrics.registry.inc('http_cache_hits_total', endpoint=endpoint)
+                self.http_cache.touch(url, entry)
+                return self._cached_data(entry), False
+        else:
+            ret = self._request(url, 'get', endpoint=endpoint)
+
+        metrics.registry.inc('http_cache_misses_total', endpoint=endpoint)
+        data = self._decode(ret, False, None, endpoint)
+        self.http_cache.store(url, ret, data)
+        return data, True
+
+    def _cached_data(self, entry):
+        # Entries loaded from disk are only parsed when first used
+        if 'data' not in entry:
+            entry['data'] = json.loads(entry['body'])
+        return entry['data']
+
+    def timeout(self, endpoint):
+        """ (connect, read) timeout for an endpoint. Per endpoint overrides
+        are given in endpoint_timeouts, eg. {'get_payouts': [5, 60]} """
+        default = (self.config['connect_timeout'], self.config['read_timeout'])
+        return tuple(self.config['endpoint_timeouts'].get(endpoint, default))
+
+    def remote(self, url, method, max_age=None, signed=True, endpoint=None, **kwargs):
+        ret = self._request(url, method, endpoint=endpoint, **kwargs)
+        return self._decode(ret, signed, max_age, endpoint)
+
+    def _request(self, url, method, endpoint=None, not_modified_ok=False, **kwargs):
         url = urljoin(self.config['rpc_url'], url)
         self.logger.debug("Making request to {}".format(url))
-        ret = getattr(requests, method)(url, timeout=270, **kwargs)
-        if ret.status_code != 200:
+        with metrics.registry.timer('sc_rpc_request', endpoint=endpoint):
+            ret = getattr(self.http, method)(url, timeout=self.timeout(endpoint),
+                                             **kwargs)
+        if ret.status_code != 200 and not (not_modified_ok and ret.status_code == 304):
+            metrics.registry.inc('sc_rpc_request_errors_total', endpoint=endpoint)
             raise SCRPCException("Non 200 from remote: {}".format(ret.text))
+        return ret
 
+    def _decode(self, ret, signed, max_age, endpoint):
         try:
-            self.logger.debug("Got {} from remote".format(ret.text.encode('utf8')))
+            # Don't re-encode potentially huge bodies just to log them
+            self.logger.debug("Got {:,} bytes from remote: {}"
+                              .format(len(ret.content), ret.content[:200]))
             if signed:
                 return self.serializer.loads(ret.text, max_age or self.config['max_age'])
             else:
                 return ret.json()
         except BadData:
+            metrics.registry.inc('sc_rpc_request_errors_total', endpoint=endpoint)
             self.logger.error("Invalid data returned from remote!", exc_info=True)
             raise SCRPCException("Invalid signature")
 
+    def count_rows(self, action, count):
+        """ Adds count to the payout_rows_total metric for action """
+        metrics.registry.inc('payout_rows_total', count, action=action,
+                             currency=self.config['currency_code'])
+
+    ########################################################################
+    # Local state helpers
+    ########################################################################
+    def get_state(self, key, default=None):
+        state = self.db.session.query(State).get(key)
+        if state is None:
+            return default
+        return state.value
+
+    def set_state(self, key, value):
+        """ Sets a state value in the current session, the caller commits """
+        self.db.session.merge(State(key=key, value=str(value)))
+
+    def delete_state(self, key):
+        self.db.session.query(State).filter_by(key=key).delete()
+
+    @contextmanager
+    def transaction_mode(self, mode):
+        """ Makes database transactions begun inside the block use the given
+        BEGIN mode instead of the default IMMEDIATE. Use DEFERRED for read
+        only work, and EXCLUSIVE only where nothing else may touch the payout
+        table, such as locking payouts around a sendmany. """
+        previous = getattr(self._txn, 'mode', 'IMMEDIATE')
+        self._txn.mode = mode
+        try:
+            yield
+        finally:
+            self._txn.mode = previous
+
+    @contextmanager
+    def read_transaction(self):
+        """ Runs the block in a DEFERRED (read) transaction which is ended
+        afterwards, so reports don't block the scheduler's writes """
+        with self.transaction_mode('DEFERRED'):
+            try:
+                yield
+            finally:
+                self.db.session.rollback()
+
+    ########################################################################
+    # Payout queries. These match the indexes built in _migrate_indexes
+    ########################################################################
+    def unpaid_query(self, locked, *entities):
+        """ Payouts for this currency without a txid """
+        return (self.db.session.query(*(entities or (Payout,)))
+                .filter(Payout.txid == None,
+                        Payout.locked == locked,
+                        Payout.currency_code == self.config['currency_code']))
+
+    def paid_query(self, associated, *entities):
+        """ Payouts for this currency with a txid """
+        return (self.db.session.query(*(entities or (Payout,)))
+                .filter(Payout.txid != None,
+                        Payout.associated == associated,
+                        Payout.currency_code == self.config['currency_code']))
+
     ########################################################################
     # RPC Client methods
     ########################################################################
+    @busy_retry
     def pull_payouts(self, simulate=False):
-        """ Gets all the unpaid payouts from the server """
+        """ Gets all the unpaid payouts from the server. With incremental_pull
+        enabled only payouts with a pid above our persisted watermark are
+        requested, except for a full resync every full_pull_interval seconds
+        to catch anything missed.
+
+        With pull_page_size set the server is asked for pages of that many
+        payouts, and each page is validated and committed on its own along
+        with the cursor for the next page. An interrupted pull resumes from
+        the last committed page.
+
+        Returns the number of new payouts, or None if SC couldn't be
+        reached. """
+        from urllib3.exceptions import ConnectionError
 
         if simulate:
             self.logger.info('#'*20 + ' Simulation mode ' + '#'*20)
 
-        try:
-            payouts = self.post(
-                'get_payouts',
-                data={'currency': self.config['currency_code']}
-            )['pids']
-        except ConnectionError:
-            self.logger.warn('Unable to connect to SC!', exc_info=True)
-            return
+        data = {'currency': self.config['currency_code']}
+        page_size = self.config['pull_page_size']
+        # Read the pull state in a read transaction that's ended before the
+        # request, so the database isn't write locked while SC answers
+        with self.read_transaction():
+            cursor = self.get_state('pull_cursor') if page_size else None
+            if cursor is not None:
+                # Resume the interrupted pull with the parameters it started with
+                full_pull = self.get_state('pull_cursor_since') is None
+                if not full_pull:
+                    data['since_pid'] = int(self.get_state('pull_cursor_since'))
+                self.logger.info("Resuming {} payout pull from cursor {}"
+                                 .format(self.config['currency_code'], cursor))
+            else:
+                full_pull = True
+                if self.config['incremental_pull']:
+                    last_full_pull = float(self.get_state('last_full_pull', 0))
+                    watermark = self.get_state('pull_watermark')
+                    if (watermark is not None and time.time() - last_full_pull <
+                            self.config['full_pull_interval']):
+                        data['since_pid'] = int(watermark)
+                        full_pull = False
+        pull_start = time.time()
+
+        received = new = repeat = invalid = 0
+        while True:
+            if page_size:
+                data['limit'] = page_size
+                data['cursor'] = cursor
+
+            try:
+                res = self.post('get_payouts', data=data)
+            except ConnectionError:
+                self.logger.warn('Unable to connect to SC!', exc_info=True)
+                return
+            payouts = res['pids']
+            cursor = res.get('next_cursor') if page_size else None
+
+            page_new, page_repeat, page_invalid = self._ingest_payouts(
+                payouts, simulate=simulate)
+            received += len(payouts)
+            new += len(page_new)
+            repeat += page_repeat
+            invalid += page_invalid
+
+            if not simulate:
+                # Pull bookkeeping is committed along with the page's rows
+                if self.config['incremental_pull'] and payouts:
+                    watermark = max(int(pid) for _, _, _, pid in payouts)
+                    old_watermark = self.get_state('pull_watermark')
+                    if old_watermark is not None:
+                        watermark = max(watermark, int(old_watermark))
+                    self.set_state('pull_watermark', watermark)
+                if cursor is not None:
+                    self.set_state('pull_cursor', cursor)
+                    if 'since_pid' in data:
+                        self.set_state('pull_cursor_since', data['since_pid'])
+                else:
+                    self.delete_state('pull_cursor')
+                    self.delete_state('pull_cursor_since')
+                    if self.config['incremental_pull'] and full_pull:
+                        self.set_state('last_full_pull', pull_start)
+            self.db.session.commit()
+            # Only index pids once they're committed
+            if not simulate:
+                self.known_pids.update(page_new)
+
+            if cursor is None:
+                break
 
-        if not payouts:
+        if not received:
             self.logger.info("No {} payouts to process.."
                              .format(self.config['currency_code']))
-            return
+            return 0
 
+        self.logger.info("Inserted {:,} new {} payouts and skipped {:,} old "
+                         "payouts from the server. {:,} payouts with invalid addresses."
+                         .format(new, self.config['currency_code'], repeat, invalid))
+        self.count_rows('pulled', new)
+        self.count_rows('repeat', repeat)
+        self.count_rows('invalid', invalid)
+        metrics.registry.set('pid_index_bytes', self.known_pids.size_bytes,
+                             currency=self.config['currency_code'])
+        return new
+
+    def _ingest_payouts(self, payouts, simulate=False):
+        """ Validates a list of (user, address, amount, pid) payouts from the
+        server and inserts the ones we don't know about into the current
+        session. Returns a tuple of (new pids, repeat count, invalid count).
+
+        Pids in known_pids are skipped without touching the database, which
+        is only asked about the rest. """
         repeat = 0
-        new = 0
         invalid = 0
+        valid = []
         for user, address, amount, pid in payouts:
             # Check address is valid
             if not get_bcaddress_version(address) in self.config['valid_address_versions']:
@@ -211,31 +640,66 @@ class SCRPCClient(object):
                                          self.config['valid_address_versions']))
                 invalid += 1
                 continue
+            valid.append((user, address, amount, pid))
+
+        valid_pids = list(set(unicode(pid) for _, _, _, pid in valid))
+        if not self.known_pids.warm and not self.known_pids.disabled:
+            self._load_known_pids()
+        known, unknown = self.known_pids.split(valid_pids)
+        known = set(known)
+
+        # Check the rest with chunked IN lookups rather than one SELECT per
+        # payout. pids are stored as text, so compare them as text too
+        found = set()
+        for chunk in chunks(unknown, self.config['db_chunk_size']):
+            for model in (Payout, ArchivedPayout):
+                found.update(pid for pid, in (self.db.session.query(model.pid)
+                                              .filter(model.pid.in_(chunk))))
+        # Inserted by another process since the index was loaded
+        self.known_pids.update(found)
+        known.update(found)
+
+        now = datetime.datetime.utcnow()
+        rows = []
+        for user, address, amount, pid in valid:
             # Check payout doesn't already exist
-            if self.db.session.query(Payout).filter_by(pid=pid).first():
+            if unicode(pid) in known:
                 self.logger.debug("Ignoring payout {} because it already exists"
                                   " locally".format((user, address, amount, pid)))
                 repeat += 1
                 continue
-            # Create local payout obj
-            p = Payout(pid=pid, user=user, address=address, amount=amount,
-                       currency_code=self.config['currency_code'],
-                       pull_time=datetime.datetime.utcnow())
-            new += 1
+            known.add(unicode(pid))
+            rows.append(dict(pid=pid, user=user, address=address, amount=amount,
+                             amount_sat=to_satoshis(amount),
+                             currency_code=self.config['currency_code'],
+                             pull_time=now))
 
-            if not simulate:
-                self.db.session.add(p)
+        if not simulate:
+            # One executemany INSERT per chunk of new payouts
+            for chunk in chunks(rows, self.config['db_chunk_size']):
+                self.db.session.execute(Payout.__table__.insert(), chunk)
 
-        self.db.session.commit()
+        return [row['pid'] for row in rows], repeat, invalid
 
-        self.logger.info("Inserted {:,} new {} payouts and skipped {:,} old "
-                         "payouts from the server. {:,} payouts with invalid addresses."
-                         .format(new, self.config['currency_code'], repeat, invalid))
-        return True
+    def _load_known_pids(self):
+        """ Fills known_pids with every live and archived pid """
+        def pids():
+            for model in (Payout, ArchivedPayout):
+                for pid, in (self.db.session.query(model.pid)
+                             .yield_per(self.config['db_chunk_size'])):
+                    yield pid
+        self.known_pids.load(pids())
 
     def send_payout(self, simulate=False):
         """ Collects all the unpaid payout ids (for the configured currency)
         and pays them out """
+        # Selecting + locking the payouts (every batch at once) and recording
+        # each txid after its sendmany are the only transactions that need the
+        # whole database
+        with self.transaction_mode('EXCLUSIVE'):
+            return self._send_payout(simulate=simulate)
+
+    def _send_payout(self, simulate=False):
         if simulate:
             self.logger.info('#'*20 + ' Simulation mode ' + '#'*20)
 
@@ -247,57 +711,42 @@ class SCRPCClient(object):
                 "{}".format(self.config['currency_code'], e))
             return False
 
-        # Grab all payouts now so that we use the same list of payouts for both
-        # database transactions (locking, and unlocking)
-        payouts = (self.db.session.query(Payout).
-                   filter_by(txid=None,
-                             locked=False,
-                             currency_code=self.config['currency_code'])
-                   .all())
+        # Total up the unpaid payouts for each address in the database
+        totals = (self.unpaid_query(False, Payout.address,
+                                    sa.func.sum(Payout.amount_sat))
+                  .group_by(Payout.address)
+                  .all())
 
-        if not payouts:
+        if not totals:
             self.logger.info("No payouts to process, exiting")
+            self.db.session.rollback()
             return True
 
-        # track the total payouts to each address
-        address_payout_amounts = {}
-        pids = {}
-        for payout in payouts:
-            address_payout_amounts.setdefault(payout.address, 0.0)
-            address_payout_amounts[payout.address] += float(payout.amount)
-            pids.setdefault(payout.address, [])
-            pids[payout.address].append(payout.pid)
-
-            # We'll lock the payout before continuing in case of a failure in
-            # between paying out and recording that payout action
-            payout.locked = True
-            payout.lock_time = datetime.datetime.utcnow()
-
-        for address, amount in address_payout_amounts.items():
-            # Convert amount from STR and coerce to a payable value.
-            # Note that we're not trying to validate the amount here, all
-            # validation should be handled server side.
-            amount = round(float(amount), 8)
-
-            if amount < self.config['minimum_tx_output']:
-                # We're unable to pay, so undo the changes from the last loop
+        # Note that we're not trying to validate the amount here, all
+        # validation should be handled server side.
+        minimum_sat = to_satoshis(self.config['minimum_tx_output'])
+        address_payout_sats = {}
+        for address, amount_sat in totals:
+            if amount_sat < minimum_sat:
                 self.logger.warn('Removing {} with payout amount of {} (which '
                                  'is lower than network output min of {}) from '
                                  'the {} payout dictionary'
-                                 .format(address, amount,
+                                 .format(address, from_satoshis(amount_sat),
                                          self.config['minimum_tx_output'],
                                          self.config['currency_code']))
-
-                address_payout_amounts.pop(address)
-                pids[address] = []
-                for payout in payouts:
-                    if payout.address == address:
-                        payout.locked = False
-                        payout.lock_time = None
             else:
-                address_payout_amounts[address] = amount
+                address_payout_sats[address] = amount_sat
 
-        total_out = sum(address_payout_amounts.values())
+        # Grab the pids being paid now so that we use the same list of payouts
+        # for every database transaction (locking, unlocking and the txid)
+        pids = {}
+        for chunk in chunks(address_payout_sats.keys(), self.config['db_chunk_size']):
+            for pid, address in (self.unpaid_query(False, Payout.pid, Payout.address)
+                                 .filter(Payout.address.in_(chunk))):
+                pids.setdefault(address, []).append(pid)
+
+        # Sum exactly in base units, then convert
+        total_out = from_satoshis(sum(address_payout_sats.values()))
         balance = self.coin_rpc.get_balance(self.coin_rpc.coinserv['account'])
         self.logger.info("Account balance for {} account \'{}\': {:,}"
                          .format(self.config['currency_code'],
@@ -315,32 +764,104 @@ class SCRPCClient(object):
             self.db.session.rollback()
             return True
 
-        if not simulate:
-            self.db.session.commit()
-        else:
+        batches = self._payout_batches(address_payout_sats)
+        batch_pids = [[pid for address in batch for pid in pids[address]]
+                      for batch in batches]
+        self.logger.info("Paying {:,} {} addresses in {:,} transaction(s)"
+                         .format(len(address_payout_sats),
+                                 self.config['currency_code'], len(batches)))
+
+        if simulate:
             self.db.session.rollback()
+            res = raw_input("Would you like the simulation to associate fake "
+                            "txids with these payouts? Don't do this on "
+                            "production. [y/n] ")
+            if res != "y":
+                self.logger.info("Exiting")
+                return True
+        else:
+            # Lock every payout being paid in the transaction that selected
+            # them, so another send_payout can't pick them up in between
+            # batches. We'll keep them locked in case of a failure in between
+            # paying out and recording that payout action. A distinct
+            # lock_time per batch lets reconcile_locked tell the sendmany
+            # calls apart
+            lock_time = datetime.datetime.utcnow()
+            for i, pids_ in enumerate(batch_pids):
+                self._update_payouts(pids_, {
+                    Payout.locked: True,
+                    Payout.lock_time: lock_time + datetime.timedelta(microseconds=i)})
+            self.db.session.commit()
+
+        results = []
+        attempted = 0
+        try:
+            for i, batch in enumerate(batches):
+                attempted = i + 1
+                batch_amounts = {address: from_satoshis(address_payout_sats[address])
+                                 for address in batch}
+                fake_txid = None
+                if simulate:
+                    fake_txid = "{:1>64x}".format(i)
+                result = self._send_batch(batch_amounts, batch_pids[i], pids, fake_txid)
+                if result is None:
+                    # The wallet may have paid without telling us, so don't
+                    # risk paying anyone else until someone has looked at it
+                    self.logger.error("Not sending the remaining {:,} {} payout "
+                                      "transactions".format(len(batches) - i - 1,
+                                                            self.config['currency_code']))
+                    break
+                if result:
+                    results.append(result)
+        finally:
+            # Batches we never got to certainly weren't paid
+            unsent = [pid for pids_ in batch_pids[attempted:] for pid in pids_]
+            if unsent and not simulate:
+                self.db.session.rollback()
+                self._update_payouts(unsent, {Payout.locked: False})
+                self.db.session.commit()
+
+        if not results:
+            return False
+        return results
+
+    def _payout_batches(self, address_payout_sats):
+        """ Splits the addresses being paid into lists small enough for one
+        sendmany each, bounded by max_tx_outputs and by the estimated size of
+        the transaction (see max_tx_bytes) """
+        max_outputs = self.config['max_tx_outputs'] or len(address_payout_sats)
+        size_outputs = ((self.config['max_tx_bytes'] - self.config['tx_input_bytes'] -
+                         TX_OVERHEAD_BYTES) // TX_OUTPUT_BYTES)
+        batch_size = max(min(max_outputs, size_outputs), 1)
+
+        # Largest payouts first, so they go out even if a later batch fails
+        addresses = sorted(address_payout_sats,
+                           key=lambda address: (-address_payout_sats[address], address))
+        return list(chunks(addresses, batch_size))
+
+    def _send_batch(self, address_payout_amounts, batch_pids, pids, fake_txid=None):
+        """ Pays one batch of already locked payouts and records its txid.
+        Returns (coin_txid, rpc_tx_obj, pids) on success, False if the payment
+        failed and the payouts were unlocked to be retried, or None if it
+        failed in a way that may have moved funds, leaving the payouts
+        locked. """
+        balance = self.coin_rpc.get_balance(self.coin_rpc.coinserv['account'])
 
         def format_pids(pids):
             lst = ", ".join(pids[:9])
             if len(pids) > 9:
                 return lst + "... ({} more)".format(len(pids) - 8)
             return lst
-        summary = [(str(address), amount, str(format_pids(upids))) for
-                   (address, amount), upids in zip(address_payout_amounts.iteritems(), pids.itervalues())]
+        summary = [(str(address), amount, str(format_pids(pids[address]))) for
+                   address, amount in address_payout_amounts.iteritems()]
 
         self.logger.info(
             "Address payment summary\n" + tabulate(summary, headers=["Address", "Total", "Pids"], tablefmt="grid"))
 
         try:
-            if simulate:
-                coin_txid = "1111111111111111111111111111111111111111111111111111111111111111"
+            if fake_txid is not None:
+                coin_txid = fake_txid
                 rpc_tx_obj = None
-                res = raw_input("Would you like the simulation to associate a "
-                                "fake txid {} with these payouts? Don't do "
-                                "this on production. [y/n] ".format(coin_txid))
-                if res != "y":
-                    self.logger.info("Exiting")
-                    return True
             else:
                 # finally run rpc call to payout
                 coin_txid, rpc_tx_obj = self.coin_rpc.send_many(
@@ -351,36 +872,38 @@ class SCRPCClient(object):
             if new_balance != balance:
                 self.logger.error(
                     "RPC error occured and wallet balance changed! Keeping the "
-                    "payout entries locked. simplecoin_rpc dump_incomplete can "
-                    "show you the details of the locked entries. If you're SURE"
-                    "a double payout hasn't occured, use simplecoin_rpc "
+                    "payout entries locked. simplecoin_rpc reconcile_locked can "
+                    "match them against the wallet's sends, and dump_incomplete "
+                    "can show you the details of the locked entries. If you're "
+                    "SURE a double payout hasn't occured, use simplecoin_rpc "
                     "reset_all_locked to reset the entries.", exc_info=True)
-                return False
+                return None
             else:
                 self.logger.error("RPC error occured and wallet balance didn't "
                                   "change. Unlocking payouts.")
-                # Reset all the payouts so we can try again later
-                for payout in payouts:
-                    payout.locked = False
-
+                # Reset the batch's payouts so we can try again later
+                self._update_payouts(batch_pids, {Payout.locked: False})
                 self.db.session.commit()
                 return False
         else:
             # Success! Now associate the txid and unlock to allow association
             # with remote to occur
-            payout_addrs = [address for address in address_payout_amounts.iterkeys()]
-            finalized_payouts = []
-            for payout in payouts:
-                if payout.address in payout_addrs:
-                    payout.locked = False
-                    payout.txid = coin_txid
-                    payout.paid_time = datetime.datetime.utcnow()
-                    finalized_payouts.append(payout)
-
+            self._update_payouts(batch_pids, {Payout.locked: False,
+                                              Payout.txid: coin_txid,
+                                              Payout.paid_time: datetime.datetime.utcnow()})
             self.db.session.commit()
             self.logger.info("Updated {:,} (local) Payouts with txid {}"
-                             .format(len(finalized_payouts), coin_txid))
-            return coin_txid, rpc_tx_obj, finalized_payouts
+                             .format(len(batch_pids), coin_txid))
+            self.count_rows('paid', len(batch_pids))
+            return coin_txid, rpc_tx_obj, batch_pids
+
+    def _update_payouts(self, pids, values):
+        """ Applies values to the given pids with set based UPDATEs, chunked
+        to stay under SQLite's bound parameter limit. Doesn't commit. """
+        for chunk in chunks(pids, self.config['db_chunk_size']):
+            (self.db.session.query(Payout)
+             .filter(Payout.pid.in_(chunk))
+             .update(values, synchronize_session=False))
 
     def associate_all(self, simulate=False):
         """
@@ -391,63 +914,81 @@ class SCRPCClient(object):
         if simulate:
             self.logger.info('#'*20 + ' Simulation mode ' + '#'*20)
 
-        payouts = (self.db.session.query(Payout).
-                   filter_by(associated=False,
-                             currency_code=self.config['currency_code']).
-                   filter(Payout.txid != None)
-                   .all())
-
-        # Build a dict keyed by txid to track payouts.
+        # Build a dict keyed by txid to track payout ids. Read without
+        # holding the write lock through the lookups and posts below
         txids = {}
-        for payout in payouts:
-            txids.setdefault(payout.txid, [])
-            txids[payout.txid].append(payout)
+        with self.read_transaction():
+            for txid, pid in self.paid_query(False, Payout.txid, Payout.pid):
+                txids.setdefault(txid, [])
+                txids[txid].append(pid)
 
         # Try to grab the fee for each txid
-        tx_fees = {}
-        for txid in txids.iterkeys():
-            try:
-                tx_fees[txid] = self.coin_rpc.get_transaction(txid).fee
-            except CoinRPCException as e:
-                self.logger.warn('Skipping transaction with id {}, failed '
-                                 'looking it up from the {} wallet'
-                                 .format(txid, self.config['currency_code']))
-                continue
-
-        for txid, payouts in txids.iteritems():
+        rpc_tx_objs, errors = self.batch_rpc.get_transactions(txids.keys())
+        for txid, e in errors.iteritems():
+            self.logger.warn('Skipping transaction with id {}, failed '
+                             'looking it up from the {} wallet: {}'
+                             .format(txid, self.config['currency_code'], e))
+            txids.pop(txid)
+        tx_fees = {txid: tx.fee for txid, tx in rpc_tx_objs.iteritems()}
+
+        for txid, pids in txids.iteritems():
             if simulate:
                 self.logger.info("Attempting remote association of {:,} ids "
-                                 "with txid {}".format(len(payouts), txid))
-            self.associate(txid, payouts, tx_fees[txid], simulate=simulate)
+                                 "with txid {}".format(len(pids), txid))
+            self.associate(txid, pids, tx_fees[txid], simulate=simulate)
 
-    def associate(self, txid, payouts, tx_fee, simulate=False):
+    def associate(self, txid, pids, tx_fee, simulate=False):
         """
-        Attempt to associate Payout objects on SC with a specific transaction ID
-        that paid them. Also post the fee incurred by the transaction.
+        Attempt to associate Payouts (by pid) on SC with a specific transaction
+        ID that paid them. Also post the fee incurred by the transaction.
+
+        The pids are posted in chunks of assoc_chunk_size, assoc_workers at a
+        time. Each chunk the server accepts is marked associated locally as
+        soon as it returns, so a later associate_all only retries the chunks
+        that failed.
         """
-        pids = [p.pid for p in payouts]
         self.logger.info("Trying to associate {:,} payouts with txid {}"
-                         .format(len(payouts), txid))
-
-        data = {'coin_txid': txid, 'pids': pids, 'tx_fee': float(tx_fee),
-                'currency': self.config['currency_code']}
+                         .format(len(pids), txid))
 
         if simulate:
             self.logger.info('We\'re simulating, so don\'t actually post to SC')
             return
 
-        res = self.post('associate_payouts', data=data)
-        if res['result']:
-            self.logger.info("Received success response from the server.")
-            for payout in payouts:
-                payout.associated = True
-                payout.assoc_time = datetime.datetime.utcnow()
-            self.db.session.commit()
-            return True
-        else:
-            self.logger.error("Failed to push association information for {} "
-                              "payouts!".format(self.config['currency_code']))
-        return False
+        def post_chunk(chunk):
+            data = {'coin_txid': txid, 'pids': chunk, 'tx_fee': float(tx_fee),
+                    'currency': self.config['currency_code']}
+            try:
+                return chunk, self.post('associate_payouts', data=data)['result']
+            except Exception:
+                self.logger.error("Error posting association of {:,} {} payouts"
+                                  .format(len(chunk), self.config['currency_code']),
+                                  exc_info=True)
+                return chunk, False
+
+        pid_chunks = list(chunks(pids, self.config['assoc_chunk_size']))
+        pool = ThreadPool(min(self.config['assoc_workers'], len(pid_chunks)) or 1)
+        failed = 0
+        try:
+            for chunk, result in pool.imap_unordered(post_chunk, pid_chunks):
+                if not result:
+                    failed += len(chunk)
+                    continue
+                self._update_payouts(chunk, {Payout.associated: True,
+                                             Payout.assoc_time: datetime.datetime.utcnow()})
+                self.db.session.commit()
+                self.count_rows('associated', len(chunk))
+        finally:
+            pool.close()
+
+        if failed:
+            self.logger.error("Failed to push association information for {:,} "
+                              "of {:,} {} payouts! They'll be retried by "
+                              "associate_all".format(failed, len(pids),
+                                                     self.config['currency_code']))
+            return False
+
+        self.logger.info("Received success response from the server.")
+        return True
 
     def local_associate_locked(self, pid, tx_id, simulate=False):
         """
@@ -455,9 +996,12 @@ class SCRPCClient(object):
         locked, with a TXID.
         """
         payout = (self.db.session.query(Payout)
-                  .filter_by(txid=None, locked=True, id=pid).all())
+                  .filter_by(txid=None, locked=True, pid=unicode(pid)).first())
+        if payout is None:
+            self.logger.error("No unpaid locked payout with id {}".format(pid))
+            return False
         self.logger.info("Associating payout id {} with TX ID {}"
-                         .format(payout.id, tx_id))
+                         .format(payout.pid, tx_id))
         if simulate:
             self.logger.info("Just kidding, we're simulating... Exit.")
             return
@@ -480,10 +1024,7 @@ class SCRPCClient(object):
         DB. After you've done this you'll still need to run the functions to
         associate everything on the remote server after.
         """
-        payouts = (self.db.session.query(Payout)
-                   .filter_by(txid=None, locked=True,
-                              currency_code=self.config['currency_code'])
-                   .all())
+        payouts = self.unpaid_query(True).all()
         self.logger.info("Associating {:,} payout ids with TX ID {}"
                          .format(len(payouts), tx_id))
         if simulate:
@@ -498,8 +1039,19 @@ class SCRPCClient(object):
 
     def confirm_trans(self, simulate=False):
         """ Grabs the unconfirmed transactions objects from the remote server
-        and checks if they're confirmed. Also grabs and pushes the fees for the
-        transaction if remote server supports it. """
+        and checks if they're confirmed.
+
+        The listing is fetched with get_cached, so an unchanged one costs a
+        304 and isn't parsed or tracked again. Confirmation progress is
+        tracked in the local transactions table, and each transaction is only
+        looked up again once enough time for its remaining confirmations has
+        passed (see block_interval). Newly confirmed txids are pushed to SC in
+        a single post.
+
+        With confirm_mode set to block, confirm_blocks is used instead. """
+        if self.config['confirm_mode'] == 'block':
+            return self.confirm_blocks(simulate=simulate)
+
         self.logger.info("Attempting to grab unconfirmed {} transactions from "
                          "SC, poking the RPC...".format(self.config['currency_code']))
         try:
@@ -510,8 +1062,9 @@ class SCRPCClient(object):
                 "{}".format(self.config['currency_code'], e))
             return False
 
-        res = self.get('api/transaction?__filter_by={{"confirmed":false,"currency":"{}"}}'
-                       .format(self.config['currency_code']), signed=False)
+        url = ('api/transaction?__filter_by={{"confirmed":false,"currency":"{}"}}'
+               .format(self.config['currency_code']))
+        res, modified = self.get_cached(url)
 
         if not res['success']:
             self.logger.error("Failure grabbing unconfirmed transactions: {}".format(res))
@@ -519,44 +1072,235 @@ class SCRPCClient(object):
 
         if not res['objects']:
             self.logger.info("No transactions were returned to confirm...exiting.")
+            # Anything we're still tracking has been confirmed on SC
+            if modified and not simulate:
+                self._track_transactions([])
+                self.db.session.commit()
+                self.http_cache.commit(url)
             return
 
-        tids = []
-        for sc_obj in res['objects']:
-            self.logger.debug("Connecting to coinserv to lookup confirms for {}"
-                              .format(sc_obj['txid']))
-            rpc_tx_obj = self.coin_rpc.get_transaction(sc_obj['txid'])
+        # An unchanged listing holds no txids we aren't tracking already
+        if modified:
+            self._track_transactions([sc_obj['txid'] for sc_obj in res['objects']])
+        else:
+            self.logger.info("Unconfirmed {} transaction list is unchanged"
+                             .format(self.config['currency_code']))
+        if not simulate:
+            # Commit the tracking before the lookups so they don't hold the
+            # database. Only now that the listing's txids are tracked can it
+            # be skipped next time it's unchanged
+            self.db.session.commit()
+            self.http_cache.commit(url)
+
+        now = datetime.datetime.utcnow()
+        with self.read_transaction():
+            due = [txid for txid, in (self.db.session.query(Transaction.txid)
+                                      .filter(Transaction.pushed == False,
+                                              Transaction.confirmed == False,
+                                              Transaction.next_check <= now))]
+        self.logger.info("{:,} of {:,} unconfirmed {} transactions are due a check"
+                         .format(len(due), len(res['objects']),
+                                 self.config['currency_code']))
+        if due:
+            self._check_transactions(due)
+
+        if simulate:
+            self.logger.info('We\'re simulating, so don\'t actually post to SC')
+            self.db.session.rollback()
+            return
 
-            if rpc_tx_obj.confirmations > self.config['min_confirms']:
-                tids.append(sc_obj['txid'])
-                self.logger.info("Confirmed txid {} with {} confirms"
-                                 .format(sc_obj['txid'], rpc_tx_obj.confirmations))
+        self.db.session.commit()
+        return self.push_confirmed()
+
+    def confirm_blocks(self, simulate=False):
+        """ Confirms our transactions from the blocks found since the last
+        run, with one listsinceblock call rather than a lookup per txid.
+
+        Transactions are tracked from our own associated payouts, so SC isn't
+        asked for its unconfirmed list. listsinceblock is called from the
+        block hash saved by the previous run with target_confirmations of
+        min_confirms + 1, so the block it returns to start from next time is
+        the newest one whose transactions are all confirmed. Tracked txids
+        it doesn't mention (eg. ones associated after their block was passed)
+        fall back to individual lookups. Newly confirmed txids are pushed to
+        SC straight away. """
+        paid = (self.paid_query(True, Payout.txid)
+                .filter(Payout.confirm_time == None)
+                .distinct())
+        self._track_new_transactions([txid for txid, in paid])
+        if not simulate:
+            self.db.session.commit()
+
+        # Read everything needed up front, so the database isn't held
+        # through the coinserver calls
+        with self.read_transaction():
+            # txid -> when it's next due an individual lookup
+            pending = dict(self.db.session.query(Transaction.txid, Transaction.next_check)
+                           .filter(Transaction.pushed == False,
+                                   Transaction.confirmed == False))
+            last_block = self.get_state('last_block', '')
+        if not pending:
+            self.logger.info("No {} transactions waiting for confirmation"
+                             .format(self.config['currency_code']))
+            return None if simulate else self.push_confirmed()
+
+        try:
+            res = self.batch_rpc.call('listsinceblock', last_block,
+                                      self.config['min_confirms'] + 1)
+            height = self.batch_rpc.call('getblockcount')
+        except CoinRPCException as e:
+            self.logger.warn("Error listing {} transactions since block {}: {}"
+                             .format(self.config['currency_code'], last_block, e))
+            return False
+
+        confirmations = {}
+        for tx in res['transactions']:
+            if tx['txid'] in pending:
+                confirmations[tx['txid']] = tx.get('confirmations', 0)
+
+        now = datetime.datetime.utcnow()
+        due = [txid for txid, next_check in pending.iteritems()
+               if txid not in confirmations and next_check is not None and
+               next_check <= now]
+        self.logger.info("{:,} of {:,} unconfirmed {} transactions were in blocks "
+                         "since {}. Looking up {:,} others"
+                         .format(len(confirmations), len(pending),
+                                 self.config['currency_code'], last_block or 'genesis',
+                                 len(due)))
+        # Before anything is written, since it makes its own lookups first
+        if due:
+            self._check_transactions(due)
+
+        block_interval = datetime.timedelta(seconds=self.config['block_interval'])
+        confirmed = 0
+        for txid, confirms in confirmations.iteritems():
+            values = {Transaction.confirmations: confirms,
+                      Transaction.last_check: now}
+            if confirms > 0:
+                values[Transaction.block_height] = height - confirms + 1
+            if confirms > self.config['min_confirms']:
+                values[Transaction.confirmed] = True
+                confirmed += 1
             else:
-                self.logger.info("TX {} not yet confirmed. {}/{} confirms"
-                                 .format(sc_obj['txid'], rpc_tx_obj.confirmations,
-                                         self.config['min_confirms']))
+                remaining = self.config['min_confirms'] + 1 - max(confirms, 0)
+                values[Transaction.next_check] = now + remaining * block_interval
+            (self.db.session.query(Transaction).filter_by(txid=txid)
+             .update(values, synchronize_session=False))
+        self.logger.info("{:,} {} transactions newly confirmed from blocks"
+                         .format(confirmed, self.config['currency_code']))
 
         if simulate:
             self.logger.info('We\'re simulating, so don\'t actually post to SC')
+            self.db.session.rollback()
             return
 
-        if tids:
-            data = {'tids': tids}
-            res = self.post('confirm_transactions', data=data)
-            if res['result']:
-                self.logger.info("Sucessfully confirmed transactions")
-                # XXX: Add number print outs
-                # XXX: Delete/archive payout row
-                return True
+        self.set_state('last_block', res['lastblock'])
+        self.db.session.commit()
+        return self.push_confirmed()
+
+    def _track_new_transactions(self, txids):
+        """ Starts tracking the given txids, ignoring those already tracked """
+        for chunk in chunks(list(txids), self.config['db_chunk_size']):
+            self.db.session.execute(
+                Transaction.__table__.insert().prefix_with("OR IGNORE"),
+                [dict(txid=txid, next_check=datetime.datetime.utcnow())
+                 for txid in chunk])
+
+    def _track_transactions(self, txids):
+        """ Starts tracking any unconfirmed SC transactions we haven't seen
+        yet, and stops tracking those SC no longer lists as unconfirmed. """
+        txids = set(txids)
+        tracked = set(txid for txid, in (self.db.session.query(Transaction.txid)
+                                         .filter(Transaction.pushed == False)))
+        self._track_new_transactions(txids - tracked)
+        gone = list(tracked - txids)
+        now = datetime.datetime.utcnow()
+        for chunk in chunks(gone, self.config['db_chunk_size']):
+            (self.db.session.query(Transaction)
+             .filter(Transaction.txid.in_(chunk))
+             .update({Transaction.pushed: True}, synchronize_session=False))
+            # SC has confirmed them without us, so they can be archived too
+            (self.db.session.query(Payout)
+             .filter(Payout.txid.in_(chunk), Payout.confirm_time == None)
+             .update({Payout.confirm_time: now}, synchronize_session=False))
+
+    def _check_transactions(self, txids):
+        """ Looks up the confirmations of the given txids and schedules the
+        next check of any that aren't confirmed yet for when enough blocks
+        should have been found. The lookups are all made before the database
+        is written to, so call it outside of a transaction. """
+        rpc_tx_objs, errors = self.batch_rpc.get_transactions(txids)
+        try:
+            height = self.batch_rpc.call('getblockcount')
+        except CoinRPCException:
+            height = None
+
+        now = datetime.datetime.utcnow()
+        block_interval = datetime.timedelta(seconds=self.config['block_interval'])
+        for txid, e in errors.iteritems():
+            self.logger.warn("Failed looking up txid {} from the {} wallet: {}"
+                             .format(txid, self.config['currency_code'], e))
+            (self.db.session.query(Transaction).filter_by(txid=txid)
+             .update({Transaction.last_check: now,
+                      Transaction.next_check: now + block_interval},
+                     synchronize_session=False))
+
+        for txid, rpc_tx_obj in rpc_tx_objs.iteritems():
+            confirmations = rpc_tx_obj.confirmations
+            values = {Transaction.confirmations: confirmations,
+                      Transaction.last_check: now}
+            if height is not None and confirmations > 0:
+                values[Transaction.block_height] = height - confirmations + 1
+
+            if confirmations > self.config['min_confirms']:
+                values[Transaction.confirmed] = True
+                self.logger.info("Confirmed txid {} with {} confirms"
+                                 .format(txid, confirmations))
+            else:
+                remaining = self.config['min_confirms'] + 1 - max(confirmations, 0)
+                values[Transaction.next_check] = now + remaining * block_interval
+                self.logger.info("TX {} not yet confirmed. {}/{} confirms"
+                                 .format(txid, confirmations,
+                                         self.config['min_confirms']))
+            (self.db.session.query(Transaction).filter_by(txid=txid)
+             .update(values, synchronize_session=False))
+
+    def push_confirmed(self):
+        """ Pushes every confirmed transaction SC doesn't know about yet in
+        one post """
+        with self.read_transaction():
+            tids = [txid for txid, in (self.db.session.query(Transaction.txid)
+                                       .filter_by(confirmed=True, pushed=False))]
+        if not tids:
+            return
 
-            self.logger.error("Failed to push confirmation information")
-            return False
+        res = self.post('confirm_transactions', data={'tids': tids})
+        if res['result']:
+            self.logger.info("Sucessfully confirmed {:,} transactions"
+                             .format(len(tids)))
+            self.count_rows('confirmed_txns', len(tids))
+            now = datetime.datetime.utcnow()
+            for chunk in chunks(tids, self.config['db_chunk_size']):
+                (self.db.session.query(Transaction)
+                 .filter(Transaction.txid.in_(chunk))
+                 .update({Transaction.pushed: True}, synchronize_session=False))
+                # Mark the payouts confirmed so archive_payouts can move them
+                (self.db.session.query(Payout)
+                 .filter(Payout.txid.in_(chunk))
+                 .update({Payout.confirm_time: now}, synchronize_session=False))
+            self.db.session.commit()
+            return True
+
+        self.logger.error("Failed to push confirmation information")
+        self.db.session.rollback()
+        return False
 
     def get_open_trade_requests(self):
         """
         Grabs the open trade requests from the server and prints off
         info about them
         """
+        from urllib3.exceptions import ConnectionError
 
         try:
             trs = self.post('get_trade_requests')['trs']
@@ -641,6 +1385,180 @@ class SCRPCClient(object):
     ########################################################################
     # Helpful local data management + analysis methods
     ########################################################################
+    @busy_retry
+    def reconcile_locked(self, blockhash=None, page_size=1000, margin=600,
+                         simulate=False):
+        """ Works out what happened to locked payouts after a failed
+        send_payout by matching them against the wallet's recent sends.
+
+        Payouts locked together (same lock_time) were sent in one sendmany,
+        paying each address the total of its payouts. Sends are read from
+        listtransactions back to margin seconds before the oldest lock, or
+        from listsinceblock if a blockhash is given. For each lock batch:
+
+        * if every address matches a send of its exact total in the same
+          transaction, that txid is recorded and the payouts unlocked
+        * if no address matches any send, and the sends read reach back
+          before the lock, nothing went out and the payouts are unlocked to
+          be paid again
+        * anything else is ambiguous, left locked and reported
+
+        Payouts locked before send_payout locked a batch at a time each have
+        their own lock_time. Those locked less than a minute apart are taken
+        to be one sendmany, which can be matched but is never unlocked.
+
+        All changes are made in one database transaction. Returns False if
+        anything was ambiguous. """
+        import calendar
+        page_size = int(page_size)
+        margin = int(margin)
+
+        def epoch(dt):
+            return calendar.timegm(dt.utctimetuple()) if dt else 0
+
+        locked = (self.unpaid_query(True, Payout.pid, Payout.address,
+                                    Payout.amount_sat, Payout.lock_time)
+                  .order_by(Payout.lock_time)
+                  .all())
+        batch_locks_since = datetime.datetime.utcfromtimestamp(
+            float(self.get_state('batch_locks_since', 0)))
+        self.db.session.rollback()
+        if not locked:
+            self.logger.info("No locked {} payouts to reconcile"
+                             .format(self.config['currency_code']))
+            return True
+
+        # (lock_time, address) -> pids, and the total the address was sent
+        groups = {}
+        # lock_times of the batches grouped from legacy locks
+        legacy = set()
+        window = last = None
+        for pid, address, amount_sat, lock_time in locked:
+            batch = lock_time
+            if lock_time is None or lock_time <= batch_locks_since:
+                if lock_time is not None and (
+                        last is None or lock_time - last > datetime.timedelta(minutes=1)):
+                    window = lock_time
+                last = lock_time
+                batch = window
+                legacy.add(batch)
+            group = groups.setdefault((batch, address), [[], 0])
+            group[0].append(pid)
+            group[1] += amount_sat
+        if legacy:
+            self.logger.warn("{:,} {} payouts were locked a payout at a time, "
+                             "they won't be unlocked if they don't match a send"
+                             .format(sum(len(groups[key][0]) for key in groups
+                                         if key[0] in legacy),
+                                     self.config['currency_code']))
+        earliest = min(epoch(lock_time) for lock_time, _ in groups) - margin
+
+        account = self.coin_rpc.coinserv['account']
+        if blockhash:
+            txs = self.batch_rpc.call('listsinceblock', blockhash)['transactions']
+            # Block times can run up to two hours ahead of the clock
+            covered = (self.batch_rpc.call('getblock', blockhash)['time'] <
+                       earliest - 7200)
+        else:
+            txs = []
+            skip = 0
+            while True:
+                page = self.batch_rpc.call('listtransactions', account, page_size, skip)
+                txs.extend(page)
+                # The wallet lists transactions in the order it got them, so
+                # once one was received before the oldest lock every send
+                # since has been read. time is the block time for those found
+                # by a rescan, so it can't tell us that
+                if len(page) < page_size or min(tx.get('timereceived', tx['time'])
+                                                for tx in page) < earliest:
+                    break
+                skip += page_size
+            covered = True
+        if not covered:
+            self.logger.warn("Block {} is too recent to show every send since "
+                             "the oldest {} lock, unmatched payouts will be left "
+                             "locked".format(blockhash, self.config['currency_code']))
+
+        # (address, amount_sat) -> [(txid, time)] for every wallet send
+        sends = {}
+        for tx in txs:
+            if tx.get('category') != 'send' or tx.get('account', account) != account:
+                continue
+            sends.setdefault((tx['address'], to_satoshis(-tx['amount'])), []).append(
+                (tx['txid'], tx['time']))
+        self.logger.info("Matching {:,} locked {} addresses against {:,} wallet sends"
+                         .format(len(groups), self.config['currency_code'],
+                                 sum(len(v) for v in sends.itervalues())))
+
+        # Outputs already recorded against other payouts can't be reused
+        txids = set(txid for matches in sends.itervalues() for txid, _ in matches)
+        used = set()
+        for chunk in chunks(list(txids), self.config['db_chunk_size']):
+            for model in (Payout, ArchivedPayout):
+                used.update(self.db.session.query(model.txid, model.address)
+                            .filter(model.txid.in_(chunk)).distinct())
+        self.db.session.rollback()
+
+        batches = {}
+        for (lock_time, address), (pids, total_sat) in groups.iteritems():
+            candidates = set(txid for txid, sent in sends.get((address, total_sat), [])
+                             if sent >= epoch(lock_time) - margin and
+                             (txid, address) not in used)
+            batches.setdefault(lock_time, []).append((address, pids, total_sat, candidates))
+
+        paid = {}
+        unlock = []
+        ambiguous = []
+        for lock_time, rows in batches.iteritems():
+            if not any(candidates for _, _, _, candidates in rows):
+                if covered and lock_time not in legacy:
+                    unlock.extend(pid for _, pids, _, _ in rows for pid in pids)
+                    continue
+            else:
+                common = set.intersection(*[candidates for _, _, _, candidates in rows])
+                if len(common) == 1:
+                    paid.setdefault(common.pop(), []).extend(
+                        pid for _, pids, _, _ in rows for pid in pids)
+                    continue
+            for address, pids, total_sat, candidates in rows:
+                ambiguous.append((lock_time, address, from_satoshis(total_sat),
+                                  len(pids), ", ".join(sorted(candidates)) or "none"))
+
+        self.logger.info("Reconciled locked {} payouts: {:,} paid in {:,} transactions, "
+                         "{:,} never sent, {:,} addresses ambiguous"
+                         .format(self.config['currency_code'],
+                                 sum(len(pids) for pids in paid.itervalues()),
+                                 len(paid), len(unlock), len(ambiguous)))
+        for txid, pids in paid.iteritems():
+            self.logger.info("{:,} payouts were paid by {}".format(len(pids), txid))
+        if ambiguous:
+            self.logger.warn(
+                "Couldn't reconcile these locked payouts, they've been left "
+                "locked:\n" + tabulate(sorted(ambiguous), headers=[
+                    "Lock time", "Address", "Total", "Payouts", "Matching sends"],
+                    tablefmt="grid"))
+
+        if simulate:
+            self.logger.info("Just kidding, we're simulating... Exit.")
+            return not ambiguous
+
+        # Only touch rows that are still locked and unpaid
+        def update(pids, values):
+            for chunk in chunks(pids, self.config['db_chunk_size']):
+                (self.db.session.query(Payout)
+                 .filter(Payout.pid.in_(chunk), Payout.locked == True,
+                         Payout.txid == None)
+                 .update(values, synchronize_session=False))
+
+        now = datetime.datetime.utcnow()
+        for txid, pids in paid.iteritems():
+            update(pids, {Payout.locked: False, Payout.txid: txid,
+                          Payout.paid_time: now})
+        update(unlock, {Payout.locked: False})
+        self.db.session.commit()
+        return not ambiguous
+
+    @busy_retry
     def reset_all_locked(self, simulate=False):
         """ Resets all locked payouts """
         payouts = self.db.session.query(Payout).filter_by(locked=True)
@@ -652,54 +1570,404 @@ class SCRPCClient(object):
         payouts.update({Payout.locked: False})
         self.db.session.commit()
 
+    @busy_retry
+    def archive_payouts(self, simulate=False):
+        """ Moves payouts that were confirmed more than archive_after_days
+        ago into the archive file, committing a chunk at a time so the
+        scheduler can run it incrementally. Gives the freed pages back to the
+        filesystem afterwards, with a full VACUUM of the live database every
+        vacuum_interval_days. """
+        cutoff = (datetime.datetime.utcnow() -
+                  datetime.timedelta(days=self.config['archive_after_days']))
+        archivable = (self.paid_query(True, Payout.id)
+                      .filter(Payout.confirm_time < cutoff))
+        if simulate:
+            self.logger.info("Would archive {:,} {} payouts confirmed before {}"
+                             .format(archivable.count(),
+                                     self.config['currency_code'], cutoff))
+            self.db.session.rollback()
+            return
+
+        columns = [c.name for c in Payout.__table__.columns if c.name != 'id']
+        moved = 0
+        while True:
+            ids = [id for id, in archivable.limit(self.config['db_chunk_size'])]
+            if not ids:
+                break
+            select = (sa.select([Payout.__table__.c[name] for name in columns] +
+                                [sa.literal(datetime.datetime.utcnow(), sa.DateTime)])
+                      .where(Payout.id.in_(ids)))
+            # A commit isn't atomic across attached WAL databases, so the
+            # copy is committed before the delete. A chunk copied by a run
+            # that died before deleting it is skipped by the OR IGNORE
+            self.db.session.execute(
+                ArchivedPayout.__table__.insert().prefix_with("OR IGNORE")
+                .from_select(columns + ['archive_time'], select))
+            self.db.session.commit()
+            (self.db.session.query(Payout)
+             .filter(Payout.id.in_(ids))
+             .delete(synchronize_session=False))
+            self.db.session.commit()
+            moved += len(ids)
+        self.db.session.commit()
+
+        if moved:
+            self.logger.info("Archived {:,} {} payouts confirmed before {}"
+                             .format(moved, self.config['currency_code'], cutoff))
+            self.count_rows('archived', moved)
+            self.incremental_vacuum()
+
+        last_vacuum = float(self.get_state('last_vacuum', 0))
+        # VACUUM can't run while our own session holds a transaction open
+        self.db.session.commit()
+        if time.time() - last_vacuum > self.config['vacuum_interval_days'] * 86400:
+            self.logger.info("Vacuuming {} database".format(self.config['currency_code']))
+            try:
+                self.engine.execute("VACUUM main")
+            except sa.exc.OperationalError as e:
+                self.logger.warn("Unable to vacuum {} database, will retry "
+                                 "next run: {}".format(self.config['currency_code'], e))
+            else:
+                self.set_state('last_vacuum', time.time())
+                self.db.session.commit()
+        return moved
+
+    def incremental_vacuum(self):
+        """ Gives the live database's free pages back to the filesystem """
+        # Each step of the pragma frees one page, so its (empty) rows all
+        # have to be read. SQLAlchemy closes results without columns before
+        # they can be, so this goes through the DBAPI cursor
+        conn = self.engine.raw_connection()
+        try:
+            conn.cursor().execute("PRAGMA main.incremental_vacuum").fetchall()
+        finally:
+            conn.close()
+
+    ########################################################################
+    # Schema migrations
+    ########################################################################
+    # Run in order. The index of the last step run is stored in the sqlite
+    # user_version, so only add new steps to the end
+    migrations = ['_migrate_create_tables',
+                  '_migrate_amount_sat',
+                  '_migrate_indexes',
+                  '_migrate_archive',
+                  '_migrate_transactions',
+                  '_migrate_confirm_time',
+                  '_migrate_covering_unpaid',
+                  '_migrate_archive_file',
+                  '_migrate_batch_locks']
+
+    def migrate(self):
+        """ Runs any schema migration steps newer than the database's
+        user_version """
+        version = self.engine.execute("PRAGMA user_version").scalar()
+        for number, step in enumerate(self.migrations[version:], version + 1):
+            self.logger.info("Running {} database migration {} ({})"
+                             .format(self.config['currency_code'], number, step))
+            getattr(self, step)()
+            self.db.session.commit()
+            self.engine.execute("PRAGMA user_version = {}".format(number))
+
+    def _migrate_create_tables(self):
+        Payout.__table__.create(self.engine, checkfirst=True)
+        State.__table__.create(self.engine, checkfirst=True)
+
+    def _migrate_amount_sat(self):
+        """ Adds and backfills the integer amount_sat column on databases
+        created before it existed. Backfills in committed chunks so the
+        payout DB isn't held locked for the whole conversion. """
+        columns = [row[1] for row in
+                   self.engine.execute("PRAGMA table_info(payouts)")]
+        if 'amount_sat' not in columns:
+            self.logger.info("Adding amount_sat column to the {} payouts table"
+                             .format(self.config['currency_code']))
+            self.engine.execute("ALTER TABLE payouts ADD COLUMN amount_sat BIGINT")
+        self.engine.execute("CREATE INDEX IF NOT EXISTS ix_payouts_amount_sat "
+                            "ON payouts (currency_code, amount_sat)")
+
+        converted = 0
+        while True:
+            rows = (self.db.session.query(Payout.id, Payout.amount)
+                    .filter(Payout.amount_sat == None)
+                    .limit(self.config['db_chunk_size'])
+                    .all())
+            if not rows:
+                break
+            self.db.session.execute(
+                Payout.__table__.update()
+                .where(Payout.id == sa.bindparam('_id'))
+                .values(amount_sat=sa.bindparam('_amount_sat')),
+                [dict(_id=id, _amount_sat=to_satoshis(amount))
+                 for id, amount in rows])
+            self.db.session.commit()
+            converted += len(rows)
+
+        if converted:
+            self.logger.info("Backfilled amount_sat for {:,} {} payouts"
+                             .format(converted, self.config['currency_code']))
+
+    def _migrate_indexes(self):
+        """ Partial indexes for the unpaid (txid IS NULL) and paid (txid IS
+        NOT NULL) payout queries. Both cover the columns the send_payout and
+        associate_all queries read so the table itself isn't touched. SQLite
+        needs txid in the index to use it for the txid IS NULL term too. """
+        self.engine.execute(
+            "CREATE INDEX IF NOT EXISTS ix_payouts_unpaid ON payouts "
+            "(currency_code, locked, address, amount_sat, pid, txid) "
+            "WHERE txid IS NULL")
+        self.engine.execute(
+            "CREATE INDEX IF NOT EXISTS ix_payouts_paid ON payouts "
+            "(currency_code, associated, txid, pid) "
+            "WHERE txid IS NOT NULL")
+
+    def _migrate_archive(self):
+        """ Adds confirm_time, the archive table, and switches the file to
+        incremental auto vacuum so archived space can be given back """
+        columns = [row[1] for row in
+                   self.engine.execute("PRAGMA table_info(payouts)")]
+        if 'confirm_time' not in columns:
+            self.engine.execute("ALTER TABLE payouts ADD COLUMN confirm_time DATETIME")
+        ArchivedPayout.__table__.create(self.engine, checkfirst=True)
+
+        # auto_vacuum can only be changed on an existing database by a VACUUM
+        if self.engine.execute("PRAGMA auto_vacuum").scalar() != 2:
+            self.logger.info("Vacuuming {} database to enable incremental "
+                             "vacuum, this may take a while..."
+                             .format(self.config['currency_code']))
+            # The pragma only applies to the connection that runs the VACUUM
+            conn = self.engine.connect()
+            try:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+
+    def _migrate_transactions(self):
+        Transaction.__table__.create(self.engine, checkfirst=True)
+        self.engine.execute(
+            "CREATE INDEX IF NOT EXISTS ix_transactions_due ON transactions "
+            "(pushed, confirmed, next_check)")
+
+    def _migrate_confirm_time(self):
+        """ Gets payouts associated before confirm_time existed archived.
+        Those whose transaction we've already pushed to SC as confirmed are
+        stamped now. The rest have their transactions tracked, so that
+        confirm_trans stamps them once SC has them as confirmed, either when
+        we push them or when SC stops listing them """
+        now = datetime.datetime.utcnow()
+        pushed = (self.db.session.query(Transaction.txid)
+                  .filter(Transaction.pushed == True))
+        (self.db.session.query(Payout)
+         .filter(Payout.associated == True,
+                 Payout.txid.in_(pushed),
+                 Payout.confirm_time == None)
+         .update({Payout.confirm_time: sa.func.coalesce(
+             Payout.assoc_time, Payout.paid_time, sa.literal(now, sa.DateTime))},
+                 synchronize_session=False))
+
+        unconfirmed = (sa.select([Payout.txid,
+                                  sa.literal(0, sa.Integer),
+                                  sa.literal(now, sa.DateTime),
+                                  sa.literal(False, sa.Boolean),
+                                  sa.literal(False, sa.Boolean)])
+                       .where(sa.and_(Payout.associated == True,
+                                      Payout.txid != None,
+                                      Payout.confirm_time == None))
+                       .distinct())
+        self.db.session.execute(
+            Transaction.__table__.insert().prefix_with("OR IGNORE")
+            .from_select(['txid', 'confirmations', 'next_check', 'confirmed',
+                          'pushed'], unconfirmed))
+
+    def _migrate_covering_unpaid(self):
+        """ Rebuilds ix_payouts_unpaid on databases indexed before it
+        included txid, which it needs to be covering """
+        self.engine.execute("DROP INDEX IF EXISTS ix_payouts_unpaid")
+        self._migrate_indexes()
+
+    def _migrate_archive_file(self):
+        """ Moves payouts_archive out of the live database into the archive
+        file, so the live file stays small and VACUUM doesn't rewrite the
+        history """
+        ArchivedPayout.__table__.create(self.engine, checkfirst=True)
+        if not self.engine.execute(
+                "SELECT 1 FROM main.sqlite_master "
+                "WHERE type = 'table' AND name = 'payouts_archive'").fetchall():
+            return
+
+        self.logger.info("Moving the {} payouts archive into {}"
+                         .format(self.config['currency_code'],
+                                 self.config['archive_path']))
+        # ids are left to the archive, as archive_payouts does
+        columns = ", ".join('"{}"'.format(c.name)
+                            for c in ArchivedPayout.__table__.columns
+                            if c.name != 'id')
+        self.db.session.execute(
+            "INSERT OR IGNORE INTO archive.payouts_archive ({0}) "
+            "SELECT {0} FROM main.payouts_archive".format(columns))
+        self.db.session.commit()
+        self.db.session.execute("DROP TABLE main.payouts_archive")
+        self.db.session.commit()
+        self.incremental_vacuum()
+
+    def _migrate_batch_locks(self):
+        """ Records when send_payout started locking payouts a batch at a
+        time, so reconcile_locked can tell older locks apart """
+        self.set_state('batch_locks_since', time.time())
+
+    def explain_queries(self):
+        """ Prints the sqlite query plan for each hot payout query and checks
+        that none of them scan the whole payouts table, and that the ones
+        reading only indexed columns never touch the table. Returns True if
+        every query uses an index, and a covering one where it should. """
+        # (name, query, whether an index should cover it)
+        queries = [
+            ("send_payout totals",
+             self.unpaid_query(False, Payout.address, sa.func.sum(Payout.amount_sat))
+             .group_by(Payout.address), True),
+            ("send_payout pids",
+             self.unpaid_query(False, Payout.pid, Payout.address)
+             .filter(Payout.address.in_(['', ''])), True),
+            ("associate_all", self.paid_query(False, Payout.txid, Payout.pid), True),
+            ("local_associate_all_locked", self.unpaid_query(True), False),
+            ("unpaid_locked", self.unpaid_query(True), False),
+            ("unpaid_unlocked", self.unpaid_query(False), False),
+            ("paid_unassoc", self.paid_query(False), False),
+            ("dump_complete", self.paid_query(True), False),
+        ]
+
+        ok = True
+        conn = self.engine.raw_connection()
+        try:
+            for name, query, covering in queries:
+                compiled = query.statement.compile(dialect=self.engine.dialect)
+                params = [compiled.params[key] for key in compiled.positiontup]
+                plan = [row[-1] for row in
+                        conn.execute("EXPLAIN QUERY PLAN " + str(compiled), params)]
+                steps = [step for step in plan if " payouts " in step + " "]
+                if any("INDEX" not in step for step in steps):
+                    status = "FULL SCAN"
+                elif covering and any("COVERING INDEX" not in step for step in steps):
+                    status = "NOT COVERING"
+                else:
+                    status = "OK"
+                if status != "OK":
+                    ok = False
+                print("{} {}".format(status, name))
+                for step in plan:
+                    print("    " + step)
+        finally:
+            conn.close()
+        return ok
+
     def init_db(self, simulate=False):
         """ Deletes all data from DB and rebuilds tables. Use carefully... """
-        Payout.__table__.drop(self.engine, checkfirst=True)
-        Payout.__table__.create(self.engine, checkfirst=True)
+        base.metadata.drop_all(self.engine)
+        self.engine.execute("PRAGMA user_version = 0")
+        self.migrate()
         self.db.session.commit()
+        self.known_pids.clear()
+
+    @contextmanager
+    def _reporting(self, writer, options):
+        """ Yields a ReportWriter built from the output options (format,
+        columns, output, page_size) in options, along with the remaining
+        filter options. Reports run in one read transaction. If writer is
+        given we're already inside another report, so it's used as is. """
+        options = dict(options)
+        output = {key: options.pop(key) for key in
+                  ('format', 'columns', 'output', 'page_size') if key in options}
+        if writer is not None:
+            yield writer, options
+            return
 
-    def _tabulate(self, title, query, headers=None, data=None):
-        """ Displays a table of payouts given a query to fetch payouts with, a
-        title to label the table, and an optional list of columns to display
-        """
-        print("@@ {} @@".format(title))
-        headers = headers if headers else ["pid", "user", "address", "amount_float", "associated", "locked", "trans_id"]
-        data = [p.tabulize(headers) for p in query]
-        if data:
-            print(tabulate(data, headers=headers, tablefmt="grid"))
-        else:
-            print("-- Nothing to display --")
-        print("")
-
-    def dump_incomplete(self, unpaid_locked=True, paid_unassoc=True, unpaid_unlocked=True):
-        """ Prints out a nice display of all incomplete payout records. """
-        if unpaid_locked:
-            self.unpaid_locked()
-        if paid_unassoc:
-            self.paid_unassoc()
-        if unpaid_unlocked:
-            self.unpaid_unlocked()
-
-    def unpaid_locked(self):
-        self._tabulate(
-            "Unpaid locked {} payouts".format(self.config['currency_code']),
-            self.db.session.query(Payout).filter_by(txid=None, locked=True).all())
-
-    def paid_unassoc(self):
-        self._tabulate(
-            "Paid un-associated {} payouts".format(self.config['currency_code']),
-            self.db.session.query(Payout).filter_by(associated=False).filter(Payout.txid != None).all())
-
-    def unpaid_unlocked(self):
-        self._tabulate(
-            "{} payouts ready to payout".format(self.config['currency_code']),
-            self.db.session.query(Payout).filter_by(txid=None, locked=False).all())
-
-    def dump_complete(self):
-        """ Prints out a nice display of all completed payout records. """
-        self._tabulate(
-            "Paid + associated {} payouts".format(self.config['currency_code']),
-            self.db.session.query(Payout).filter_by(associated=True).filter(Payout.txid != None).all())
+        from simplecoin_rpc_client.reports import ReportWriter
+        if isinstance(output.get('columns'), basestring):
+            output['columns'] = output['columns'].split(',')
+        if 'page_size' in output:
+            output['page_size'] = int(output['page_size'])
+        writer = ReportWriter(**output)
+        try:
+            with self.read_transaction():
+                yield writer, options
+        finally:
+            writer.close()
+
+    def _report(self, writer, title, model, query, time_column, since=None,
+                until=None, user=None, address=None, txid=None, limit=None):
+        """ Streams the payouts matched by query into a section of writer.
+        The filters are applied in SQL, with since/until compared against
+        time_column, and rows are fetched db_chunk_size at a time as plain
+        tuples rather than ORM objects. """
+        from simplecoin_rpc_client.reports import parse_time
+
+        if since is not None:
+            query = query.filter(time_column >= parse_time(since))
+        if until is not None:
+            query = query.filter(time_column < parse_time(until))
+        for column, value in ((model.user, user), (model.address, address),
+                              (model.txid, txid)):
+            if value is not None:
+                query = query.filter(column == value)
+        query = query.order_by(model.id)
+        if limit:
+            query = query.limit(int(limit))
+
+        rows = (query.with_entities(*model.__table__.columns)
+                .yield_per(self.config['db_chunk_size']))
+        return writer.section(title, (PayoutColumns.tabulize_row(row, writer.columns)
+                                      for row in rows))
+
+    def dump_incomplete(self, unpaid_locked=True, paid_unassoc=True,
+                        unpaid_unlocked=True, **options):
+        """ Prints out a nice display of all incomplete payout records.
+
+        Every report takes format (table, csv or jsonl), output (a file path,
+        default stdout), columns, page_size (rows per table), the filters
+        since/until (dates), user, address and txid, and a limit on rows. """
+        with self._reporting(None, options) as (writer, filters):
+            if unpaid_locked:
+                self.unpaid_locked(writer, **filters)
+            if paid_unassoc:
+                self.paid_unassoc(writer, **filters)
+            if unpaid_unlocked:
+                self.unpaid_unlocked(writer, **filters)
+
+    def unpaid_locked(self, writer=None, **options):
+        with self._reporting(writer, options) as (writer, filters):
+            self._report(
+                writer, "Unpaid locked {} payouts".format(self.config['currency_code']),
+                Payout, self.unpaid_query(True), Payout.lock_time, **filters)
+
+    def paid_unassoc(self, writer=None, **options):
+        with self._reporting(writer, options) as (writer, filters):
+            self._report(
+                writer, "Paid un-associated {} payouts".format(self.config['currency_code']),
+                Payout, self.paid_query(False), Payout.paid_time, **filters)
+
+    def unpaid_unlocked(self, writer=None, **options):
+        with self._reporting(writer, options) as (writer, filters):
+            self._report(
+                writer, "{} payouts ready to payout".format(self.config['currency_code']),
+                Payout, self.unpaid_query(False), Payout.pull_time, **filters)
+
+    def dump_complete(self, include_archive=False, **options):
+        """ Prints out a nice display of all completed payout records.
+        Archived payouts are only read when include_archive is given. Takes
+        the same options as dump_incomplete, with since/until matching the
+        time the payouts were paid. """
+        with self._reporting(None, options) as (writer, filters):
+            self._report(
+                writer, "Paid + associated {} payouts".format(self.config['currency_code']),
+                Payout, self.paid_query(True), Payout.paid_time, **filters)
+            if include_archive:
+                self._report(
+                    writer, "Archived {} payouts".format(self.config['currency_code']),
+                    ArchivedPayout,
+                    self.db.session.query(ArchivedPayout)
+                    .filter_by(currency_code=self.config['currency_code']),
+                    ArchivedPayout.paid_time, **filters)
 
     def call(self, command, **kwargs):
         try:
@@ -710,6 +1978,10 @@ class SCRPCClient(object):
             return False
 
 def entry():
+    import argparse
+    import yaml
+    from cryptokit.rpc_wrapper import CoinRPC
+
     parser = argparse.ArgumentParser(prog='simplecoin RPC')
     parser.add_argument('-c', '--config', default='config.yml', type=argparse.FileType('r'))
     parser.add_argument('-l', '--log-level',
@@ -722,6 +1994,11 @@ def entry():
     subparsers.add_parser('payout', help='pays out all ready payout records')
     subparsers.add_parser('pull_payouts', help='pulls down new payouts that are ready from the server')
     subparsers.add_parser('reset_all_locked', help='resets all locked payouts')
+    reconcile = subparsers.add_parser(
+        'reconcile_locked', help='matches locked payouts against the wallet\'s '
+        'sends, recording their txid or unlocking them')
+    reconcile.add_argument('--blockhash', default=None,
+                           help='read sends with listsinceblock from this block')
     subparsers.add_parser('dump_incomplete', help='')
     subparsers.add_parser('associate_all', help='')
 
@@ -735,5 +2012,5 @@ def entry():
     config = yaml.load(args.config)
     if args.log_level:
         config['log_level'] = args.log_level
-    interface = SCRPCClient(config)
+    interface = SCRPCClient(config, CoinRPC(config))
     interface.call(args.action, **kwargs)
@@ -1,14 +1,20 @@
 import logging
 import os
+import Queue
+import threading
+import time
 import decorator
 import sqlalchemy
 import setproctitle
 import argparse
 import yaml
 
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 from apscheduler.scheduler import Scheduler
 from cryptokit.rpc_wrapper import CoinRPC
 from simplecoin_rpc_client.sc_rpc import SCRPCClient
+from simplecoin_rpc_client import metrics, webhook
 
 logger = logging.getLogger('apscheduler.scheduler')
 os_root = os.path.abspath(os.path.dirname(__file__) + '/../')
@@ -16,60 +22,279 @@ os_root = os.path.abspath(os.path.dirname(__file__) + '/../')
 
 @decorator.decorator
 def crontab(func, *args, **kwargs):
-    """ Handles rolling back SQLAlchemy exceptions to prevent breaking the
-    connection for the whole scheduler. Also records timing information into
-    the cache """
+    """ Logs exceptions so that one failed run doesn't stop the job. Each
+    currency's database session is rolled back by _run_currency. Also
+    records timing information into the metrics registry """
     self = args[0]
 
     res = None
+    start = time.time()
     try:
         res = func(*args, **kwargs)
     except sqlalchemy.exc.SQLAlchemyError as e:
-        logger.error("SQLAlchemyError occurred, rolling back: {}".format(e))
-        self.db.session.rollback()
+        metrics.registry.inc('scheduler_job_errors_total', job=func.__name__)
+        logger.error("SQLAlchemyError occurred in {}: {}".format(func.__name__, e))
     except Exception:
+        metrics.registry.inc('scheduler_job_errors_total', job=func.__name__)
         self.logger.error("Unhandled exception in {}".format(func.__name__),
                           exc_info=True)
+    finally:
+        metrics.registry.observe('scheduler_job_seconds', time.time() - start,
+                                 job=func.__name__)
 
     return res
 
 
 class PayoutManager(object):
 
-    def __init__(self, logger, sc_rpc, coin_rpc):
+    def __init__(self, logger, sc_rpc, coin_rpc, workers=None,
+                 currency_timeout=None, poll_min_interval=60,
+                 poll_max_interval=60, poll_backoff=2):
         self.logger = logger
         self.sc_rpc = sc_rpc
         self.coin_rpc = coin_rpc
 
+        # Each currency has its own sqlite file and coinserver, so every
+        # currency's job can run in its own worker
+        self.pool = ThreadPool(workers or max(len(sc_rpc), 1))
+        self.currency_timeout = currency_timeout
+        # A client's db session must only be used by one job at a time
+        self.currency_locks = {currency: threading.Lock() for currency in sc_rpc}
+
+        # Adaptive pulling. Each currency is pulled every poll_min_interval
+        # seconds while SC has payouts for it, backing off by poll_backoff
+        # times per empty pull up to poll_max_interval
+        self.poll_min_interval = poll_min_interval
+        self.poll_max_interval = max(poll_max_interval, poll_min_interval)
+        self.poll_backoff = poll_backoff
+        self.pull_interval = {currency: poll_min_interval for currency in sc_rpc}
+        self.next_pull = {currency: 0 for currency in sc_rpc}
+        # When each currency's pull was last triggered by a notification
+        self.pull_triggered = {currency: 0 for currency in sc_rpc}
+
+    def _run_currency(self, currency, func, skip_if_busy, started=None):
+        """ Runs func against one currency's SCRPCClient, isolating any
+        failures from the other currencies. Returns the duration in seconds,
+        or None if the currency was skipped. The time it began running is put
+        on the started queue if one is given. """
+        if started is not None:
+            started.put(time.time())
+        lock = self.currency_locks[currency]
+        if not lock.acquire(not skip_if_busy):
+            metrics.registry.inc('currency_job_skipped_total',
+                                 job=func.__name__, currency=currency)
+            self.logger.warn("{} is still busy with a previous job, skipping {}"
+                             .format(currency, func.__name__))
+            return None
+
+        sc_rpc = self.sc_rpc[currency]
+        start = time.time()
+        try:
+            func(sc_rpc)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            metrics.registry.inc('currency_job_errors_total',
+                                 job=func.__name__, currency=currency)
+            self.logger.error("SQLAlchemyError occurred in {} {}, rolling back: {}"
+                              .format(currency, func.__name__, e))
+        except Exception:
+            metrics.registry.inc('currency_job_errors_total',
+                                 job=func.__name__, currency=currency)
+            self.logger.error("Unhandled exception in {} {}"
+                              .format(currency, func.__name__), exc_info=True)
+        finally:
+            # The next job for this currency may run on another worker, and
+            # sqlite connections can't follow it there, so end any
+            # transaction and hand the connection back to the pool
+            try:
+                sc_rpc.db.session.close()
+            except Exception:
+                self.logger.error("Failed closing {} database session"
+                                  .format(currency), exc_info=True)
+            lock.release()
+        duration = time.time() - start
+        metrics.registry.observe('currency_job_seconds', duration,
+                                 job=func.__name__, currency=currency)
+        return duration
+
+    def run_currencies(self, func, skip_if_busy=False, currencies=None):
+        """ Runs func(sc_rpc) for every currency (or just the given
+        currencies) concurrently on the worker pool, waiting up to
+        currency_timeout seconds for each from when it starts running, then
+        logs a summary of how long each currency took. """
+        results = {}
+        for currency in (self.sc_rpc if currencies is None else currencies):
+            started = Queue.Queue(1)
+            results[currency] = (self.pool.apply_async(
+                self._run_currency, (currency, func, skip_if_busy, started)), started)
+
+        durations = []
+        for currency, (result, started) in sorted(results.iteritems()):
+            try:
+                duration = self._wait(result, started, len(results))
+            except TimeoutError:
+                metrics.registry.inc('currency_job_timeouts_total',
+                                     job=func.__name__, currency=currency)
+                self.logger.error("{} {} didn't finish within {}s, leaving it "
+                                  "running in the background"
+                                  .format(currency, func.__name__,
+                                          self.currency_timeout))
+                durations.append("{}=timeout".format(currency))
+            except Exception:
+                # _run_currency handles the job's own errors, so this is a
+                # bug, but it mustn't stop us waiting on the other currencies
+                metrics.registry.inc('currency_job_errors_total',
+                                     job=func.__name__, currency=currency)
+                self.logger.error("{} {} failed".format(currency, func.__name__),
+                                  exc_info=True)
+                durations.append("{}=error".format(currency))
+            else:
+                if duration is None:
+                    durations.append("{}=skipped".format(currency))
+                else:
+                    durations.append("{}={:.2f}s".format(currency, duration))
+
+        self.logger.info("{} per currency durations: {}"
+                         .format(func.__name__, ", ".join(durations)))
+
+    def _wait(self, result, started, queued):
+        """ Waits for a job from run_currencies. With fewer workers than
+        currencies a job may sit in the pool's queue first, so its
+        currency_timeout only starts once it's running. It may wait behind at
+        most queued other jobs, each of which gets its own timeout """
+        if not self.currency_timeout:
+            return result.get()
+        try:
+            start = started.get(timeout=self.currency_timeout * queued)
+        except Queue.Empty:
+            raise TimeoutError
+        return result.get(max(start + self.currency_timeout - time.time(), 0))
+
+    @property
+    def poll_tick(self):
+        """ How often in seconds pull_payouts should be run to check which
+        currencies are due """
+        return min(self.poll_min_interval, 60)
+
+    def _schedule_pull(self, currency, start, new):
+        """ Works out when currency should next be pulled, given how many new
+        payouts the pull that began at start inserted. Payouts we already
+        have don't count, since SC keeps returning the unpaid backlog until
+        it's sent """
+        if new:
+            interval = self.poll_min_interval
+        else:
+            interval = min(self.pull_interval[currency] * self.poll_backoff,
+                           self.poll_max_interval)
+        if interval != self.pull_interval[currency]:
+            self.logger.debug("Pulling {} payouts every {}s"
+                              .format(currency, interval))
+        self.pull_interval[currency] = interval
+        if self.pull_triggered[currency] > start:
+            # Notified while this pull was running, which may have missed
+            # the new payouts, so pull again on the next tick
+            self.next_pull[currency] = 0
+        else:
+            self.next_pull[currency] = start + interval
+
+    def _pull_payouts(self, start):
+        def pull_payouts(sc_rpc):
+            new = None
+            try:
+                new = sc_rpc.pull_payouts()
+            finally:
+                # Failed pulls back off the same as empty ones
+                self._schedule_pull(sc_rpc.config['currency_code'], start, new)
+        return pull_payouts
+
     @crontab
     def pull_payouts(self):
-        for currency, sc_rpc in self.sc_rpc.iteritems():
-            sc_rpc.pull_payouts()
+        # Allow a second of slack so that jitter in when the job fires
+        # doesn't push a due currency back a whole tick
+        start = time.time()
+        due = [currency for currency, next_pull in self.next_pull.iteritems()
+               if next_pull <= start + 1]
+        if not due:
+            return
+        # Skip rather than queue up behind a currency that is still pulling
+        # or paying out, the next tick will pick it up
+        self.run_currencies(self._pull_payouts(start), skip_if_busy=True,
+                            currencies=due)
+
+    def trigger_pull(self, currency):
+        """ Pulls currency's payouts right away in the background, eg.
+        because SC told us it has new ones """
+        self.logger.info("Triggered a {} payout pull".format(currency))
+        # If a pull is already running it may have missed the new payouts,
+        # so make sure the next tick pulls again, even once that pull has
+        # rescheduled itself
+        now = time.time()
+        self.pull_triggered[currency] = now
+        self.next_pull[currency] = 0
+        self.pool.apply_async(self._run_currency,
+                              (currency, self._pull_payouts(now), True))
+
+    def trigger_confirm(self, currency):
+        """ Confirms currency's transactions right away in the background, eg.
+        because its coinserver found a block """
+        def confirm_trans(sc_rpc):
+            sc_rpc.confirm_trans()
+        self.pool.apply_async(self._run_currency, (currency, confirm_trans, True))
+
+    def watch_blocknotify(self, interval=1):
+        """ Watches each currency's blocknotify_file, which its coinserver
+        touches on every new block (-blocknotify="touch <file>"), and
+        confirms that currency's transactions whenever it changes. Runs
+        forever, so start it in its own thread. """
+        mtimes = {}
+        while True:
+            for currency, sc_rpc in self.sc_rpc.iteritems():
+                path = sc_rpc.config['blocknotify_file']
+                if not path:
+                    continue
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if currency in mtimes and mtime != mtimes[currency]:
+                    self.logger.debug("New {} block, confirming transactions"
+                                      .format(currency))
+                    self.trigger_confirm(currency)
+                mtimes[currency] = mtime
+            time.sleep(interval)
 
     @crontab
     def send_payout(self):
-        for currency, sc_rpc in self.sc_rpc.iteritems():
-
+        def send_payout(sc_rpc):
             # Try to pay out known payouts
-            result = sc_rpc.send_payout()
-            if isinstance(result, bool):
-                continue
+            results = sc_rpc.send_payout()
+            if isinstance(results, bool):
+                return
             else:
-                coin_txid, tx, payouts = result
                 sc_rpc.associate_all()
 
-            # Push completed payouts to SC
-            sc_rpc.associate(coin_txid, payouts, tx.fee)
+            # Push completed payouts to SC, one transaction at a time
+            for coin_txid, tx, pids in results:
+                sc_rpc.associate(coin_txid, pids, tx.fee)
+        self.run_currencies(send_payout)
 
     @crontab
     def associate_all_payouts(self):
-        for currency, sc_rpc in self.sc_rpc.iteritems():
+        def associate_all(sc_rpc):
             sc_rpc.associate_all()
+        self.run_currencies(associate_all)
 
     @crontab
     def confirm_payouts(self):
-        for currency, sc_rpc in self.sc_rpc.iteritems():
+        def confirm_trans(sc_rpc):
             sc_rpc.confirm_trans()
+        self.run_currencies(confirm_trans)
+
+    @crontab
+    def archive_payouts(self):
+        def archive_payouts(sc_rpc):
+            sc_rpc.archive_payouts()
+        # Archiving is only housekeeping, so leave busy currencies for later
+        self.run_currencies(archive_payouts, skip_if_busy=True)
 
     @crontab
     def init_db(self):
@@ -87,8 +312,10 @@ class PayoutManager(object):
             sc_rpc.dump_complete()
 
 
-def entry():
-    parser = argparse.ArgumentParser(prog='simplecoin rpc client scheduler')
+def setup(prog):
+    """ Parses the command line, sets up logging and builds the
+    PayoutManager for every enabled currency in the config """
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument('-l', '--log-level',
                         choices=['DEBUG', 'INFO', 'WARN', 'ERROR'],
                         default='INFO')
@@ -111,6 +338,8 @@ def entry():
     # Setup our CoinRPCs + SCRPCClients
     coin_rpc = {}
     sc_rpc = {}
+    # All currencies share one pooled HTTP session to SC
+    http_session = None
     for curr_cfg in cfg['currencies']:
 
         if not curr_cfg['enabled']:
@@ -120,22 +349,67 @@ def entry():
         coin_rpc[cc] = CoinRPC(curr_cfg, logger=logger)
 
         curr_cfg.update(cfg['sc_rpc_client'])
-        sc_rpc[cc] = SCRPCClient(curr_cfg, coin_rpc[cc], logger=logger)
+        sc_rpc[cc] = SCRPCClient(curr_cfg, coin_rpc[cc], logger=logger,
+                                 http_session=http_session)
+        http_session = sc_rpc[cc].http
+
+    sched_cfg = cfg.get('scheduler') or {}
+
+    # Expose job, RPC and database timings in the Prometheus text format
+    if sched_cfg.get('metrics_listen'):
+        address, port = sched_cfg['metrics_listen'].rsplit(':', 1)
+        metrics.serve(address, int(port))
+        logger.info("Serving metrics on http://{}/metrics"
+                    .format(sched_cfg['metrics_listen']))
+    if sched_cfg.get('metrics_file'):
+        metrics.write_periodically(sched_cfg['metrics_file'],
+                                   sched_cfg.get('metrics_interval', 60))
+
+    pm = PayoutManager(logger, sc_rpc, coin_rpc,
+                       workers=sched_cfg.get('workers'),
+                       currency_timeout=sched_cfg.get('currency_timeout'),
+                       poll_min_interval=sched_cfg.get('poll_min_interval', 60),
+                       poll_max_interval=sched_cfg.get('poll_max_interval', 60),
+                       poll_backoff=sched_cfg.get('poll_backoff', 2))
+
+    # Let SC push "payouts ready" notifications instead of waiting for the
+    # next poll
+    if sched_cfg.get('webhook_listen'):
+        address, port = sched_cfg['webhook_listen'].rsplit(':', 1)
+        webhook.serve(address, int(port), pm)
+        logger.info("Listening for payout notifications on http://{}/payouts_ready/"
+                    .format(sched_cfg['webhook_listen']))
+
+    # Confirm transactions as soon as a coinserver reports a new block
+    if any(client.config['blocknotify_file'] for client in sc_rpc.itervalues()):
+        thread = threading.Thread(target=pm.watch_blocknotify)
+        thread.daemon = True
+        thread.start()
+
+    return pm
+
+
+def add_jobs(sched, pm):
+    # All these tasks actually change the database, and shouldn't
+    # be run by the staging server
+    # Runs every poll_tick seconds, but only pulls the currencies that are
+    # due (see PayoutManager.pull_payouts)
+    sched.add_cron_job(pm.pull_payouts, second='*/{}'.format(pm.poll_tick))
+    sched.add_cron_job(pm.send_payout, hour='23')
+    sched.add_cron_job(pm.associate_all_payouts, hour='0')
+    sched.add_cron_job(pm.confirm_payouts, hour='1')
+    sched.add_cron_job(pm.archive_payouts, minute='30')
+
 
-    pm = PayoutManager(logger, sc_rpc, coin_rpc)
+def entry():
+    pm = setup('simplecoin rpc client scheduler')
 
     sched = Scheduler(standalone=True)
     logger.info("=" * 80)
     logger.info("SimpleCoin cron scheduler starting up...")
     setproctitle.setproctitle("simplecoin_scheduler")
 
-    # All these tasks actually change the database, and shouldn't
-    # be run by the staging server
-    sched.add_cron_job(pm.pull_payouts, minute='*/1')
-    sched.add_cron_job(pm.send_payout, hour='23')
-    sched.add_cron_job(pm.associate_all_payouts, hour='0')
-    sched.add_cron_job(pm.confirm_payouts, hour='1')
-
+    add_jobs(sched, pm)
 
     sched.start()
 
@@ -0,0 +1,50 @@
+import threading
+
+from itsdangerous import BadData
+
+
+def serve(address, port, pm):
+    """ Listens for SC's "payouts ready" notifications from a daemon thread
+    and triggers an immediate pull for the currency they name.
+
+    SC POSTs to /payouts_ready/<currency> with a body signed the same way as
+    our RPC requests, containing {'currency': <currency>} """
+    import BaseHTTPServer
+
+    class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            prefix, _, currency = self.path.rpartition('/')
+            if prefix != '/payouts_ready' or currency not in pm.sc_rpc:
+                return self.reply(404, 'Unknown currency')
+
+            sc_rpc = pm.sc_rpc[currency]
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                data = sc_rpc.serializer.loads(body, sc_rpc.config['max_age'])
+            except BadData:
+                pm.logger.warn("Ignoring {} payout notification with an invalid "
+                               "signature from {}"
+                               .format(currency, self.client_address[0]))
+                return self.reply(403, 'Invalid signature')
+
+            if not isinstance(data, dict) or data.get('currency') != currency:
+                return self.reply(400, 'Currency mismatch')
+
+            pm.trigger_pull(currency)
+            self.reply(200, 'OK')
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((address, port), WebhookHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server